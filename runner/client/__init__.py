@@ -1,2 +1,2 @@
 # coding: utf-8
-from .file import update_asset
+from .file import update_asset, merge_updates, batch_updates
@@ -1,8 +1,30 @@
 import requests
 import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from PIL import Image
-from ..config import API_URL, TOKEN, ID, ROOT_DIRECTORY
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from ..config import API_URL, TOKEN, ID, ROOT_DIRECTORY, API_TIMEOUT, API_POOL_SIZE, API_RETRIES, \
+    API_RETRY_BACKOFF, ROOT_PATH_CACHE_TTL, ROOT_PATH_CACHE_SIZE
 from ..utils.file import gen_random_id
+from ..utils.cache import TTLCache
+
+# keep-alive connections to the backend, shared by all requests of a process.
+# Connection errors are retried for every method, read errors and gateway errors
+# only for the idempotent GET and PUT requests.
+retry = Retry(total=API_RETRIES, backoff_factor=API_RETRY_BACKOFF, status_forcelist=(502, 503, 504),
+              allowed_methods=frozenset(['GET', 'PUT']), raise_on_status=False)
+adapter = HTTPAdapter(pool_connections=API_POOL_SIZE, pool_maxsize=API_POOL_SIZE, max_retries=retry)
+session = requests.Session()
+session.mount('http://', adapter)
+session.mount('https://', adapter)
+
+# asset updates buffered by `batch_updates`, per thread
+buffer = threading.local()
+
+root_paths = TTLCache(maxsize=ROOT_PATH_CACHE_SIZE, ttl=ROOT_PATH_CACHE_TTL)
 
 
 def add_asset(body):
@@ -11,7 +33,7 @@ def add_asset(body):
 
     try:
         print('add asset: \n', body)
-        resp = requests.post(url, json=body)
+        resp = session.post(url, json=body, timeout=API_TIMEOUT)
         print(resp.json())
         if not resp.status_code == 200:
             return False, resp.json()
@@ -21,28 +43,94 @@ def add_asset(body):
         return False, None
 
 
+def merge_updates(target, body):
+    """Deep-merges the asset update `body` into `target`."""
+    for key, value in body.items():
+        if key == 'token':
+            continue
+        if isinstance(value, dict):
+            if not isinstance(target.get(key), dict):
+                target[key] = {}
+            merge_updates(target[key], value)
+        else:
+            target[key] = value
+    return target
+
+
 def update_asset(_id, body):
+    """Sends a partial update of an asset, buffered instead inside `batch_updates`."""
+    updates = getattr(buffer, 'updates', None)
+    if updates is not None:
+        merge_updates(updates.setdefault(_id, {}), body)
+        return True
+    return send_update(_id, body)
+
+
+def send_update(_id, body):
     body['token'] = TOKEN
     url = '{0}/runner/assets/{1}'.format(API_URL, _id)
 
     try:
         print(url)
         print('updated asset: \n', body)
-        resp = requests.put(url, json=body)
+        resp = session.put(url, json=body, timeout=API_TIMEOUT)
         print(resp.json())
         return True
     except Exception as e:
         print(e)
         return False
 
+
+@contextmanager
+def batch_updates():
+    """Coalesces the `update_asset` calls made inside the block.
+
+    Successive partial updates of an asset are deep-merged, later values winning,
+    and sent as a single PUT per asset when the block exits, also on errors.
+    Nested blocks join the outermost one.
+    """
+    if getattr(buffer, 'updates', None) is not None:
+        yield
+        return
+    buffer.updates = OrderedDict()
+    try:
+        yield
+    finally:
+        updates, buffer.updates = buffer.updates, None
+        for _id, body in updates.items():
+            send_update(_id, body)
+
+
 def get_root_path(_id):
+    """Returns the user's root path, cached for `ROOT_PATH_CACHE_TTL` seconds.
+
+    Failed lookups return None and aren't cached.
+    """
+    missing = object()
+    root_path = root_paths.get(_id, missing)
+    if root_path is not missing:
+        return root_path
+
     body = {
         'token': TOKEN,
     }
-    try: 
+    try:
         url = '{0}/runner/users/{1}/path'.format(API_URL, _id)
-        resp = requests.get(url, json=body)
-        return resp.json()['result']
+        resp = session.get(url, json=body, timeout=API_TIMEOUT)
+        if not resp.status_code == 200:
+            print(resp.json())
+            return None
+        root_path = resp.json().get('result')
+        root_paths.set(_id, root_path)
+        return root_path
     except Exception as e:
         print(e)
         return None
+
+
+def invalidate_root_path(_id=None):
+    """Drops the cached root path of a user, or of all users when `_id` is None."""
+    if _id is None:
+        root_paths.clear()
+    else:
+        root_paths.pop(_id)
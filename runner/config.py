@@ -1,9 +1,17 @@
 # coding: utf-8
+import json
 import os
 
 # Backend config
 API_ACCESS_TOKEN = os.getenv('API_ACCESS_TOKEN') or ''
 API_URL = os.getenv('BACKEND_API_URL') or ''
+API_TIMEOUT = float(os.getenv('BACKEND_API_TIMEOUT') or 10)
+API_POOL_SIZE = int(os.getenv('BACKEND_API_POOL_SIZE') or 10)
+API_RETRIES = int(os.getenv('BACKEND_API_RETRIES') or 3)
+API_RETRY_BACKOFF = float(os.getenv('BACKEND_API_RETRY_BACKOFF') or 0.5)
+# users' root paths almost never change, lookups are cached for this many seconds
+ROOT_PATH_CACHE_TTL = int(os.getenv('ROOT_PATH_CACHE_TTL') or 300)
+ROOT_PATH_CACHE_SIZE = int(os.getenv('ROOT_PATH_CACHE_SIZE') or 1024)
 
 # Runner config
 ID = os.getenv('RUNNER_ID') or ''
@@ -14,6 +22,70 @@ STREAM_CONFIG_FILE = os.getenv('STREAM_CONFIG_FILE') or '/home/ubuntu/streamer/c
 LIVE_TEXT_FILE = os.getenv('LIVE_TEXT_FILE') or '/home/ubuntu/media-node-data/live_stream_text_scroll.txt'
 TIME_ZONE = os.getenv('TIME_ZONE') or 'UTC'
 
+# download config
+# whole files are always handed to the WSGI server's file_wrapper (gunicorn uses sendfile(2)).
+# single ranges are read through the runner in 'stream' mode, 'sendfile' also hands them over,
+# seeked to the range, which needs a server that stops at Content-Length as gunicorn does.
+# 'accel' delegates to nginx via X-Accel-Redirect
+DOWNLOAD_MODE = os.getenv('DOWNLOAD_MODE') or 'stream'
+ACCEL_REDIRECT_LOCATION = os.getenv('ACCEL_REDIRECT_LOCATION') or '/internal-files'
+DOWNLOAD_CACHE_CONTROL = os.getenv('DOWNLOAD_CACHE_CONTROL') or 'no-cache'
+
+# encode config
+# 'serial' encodes the renditions one after another, 'single' decodes the source once
+# and encodes every rendition in one ffmpeg process, 'parallel' runs one ffmpeg
+# process per rendition at the same time and 'chunked' encodes parts of long sources
+# at the same time
+ENCODE_MODE = os.getenv('ENCODE_MODE') or 'serial'
+# threads shared by the ffmpeg processes of an encode
+ENCODE_THREADS = int(os.getenv('ENCODE_THREADS') or os.cpu_count() or 1)
+# HLS renditions, given landscape. They are turned for portrait sources and skipped when wider
+# or taller than the source. `codec` and `profile` are optional and default to the encoder's
+# video codec and its default profile
+ENCODE_LADDER = json.loads(os.getenv('ENCODE_LADDER') or '''[
+    {"name": "720p", "width": 1280, "height": 720, "bitrate": 3000, "codec": "libx264", "profile": "high"},
+    {"name": "1080p", "width": 1920, "height": 1080, "bitrate": 5000, "codec": "libx264", "profile": "high"}
+]''')
+# 'chunked' mode splits the source at scene cuts into chunks of about this many seconds
+# and encodes ENCODE_CHUNK_JOBS of them at a time. With ENCODE_CHUNK_QUEUE set the chunks
+# are queued there instead, for `rq worker <queue>` processes on nodes sharing the media storage.
+# The queue needs workers of its own, while none but the encoding one serve it the chunks are encoded locally
+ENCODE_CHUNK_DURATION = int(os.getenv('ENCODE_CHUNK_DURATION') or 300)
+ENCODE_CHUNK_JOBS = int(os.getenv('ENCODE_CHUNK_JOBS') or max(1, ENCODE_THREADS // 4))
+ENCODE_CHUNK_QUEUE = os.getenv('ENCODE_CHUNK_QUEUE') or ''
+# 'fast' scores scene changes on a downscaled stream decimated to SCENE_DETECT_FPS frames
+# per second, 'full' scores every frame of the source
+SCENE_DETECT_MODE = os.getenv('SCENE_DETECT_MODE') or 'fast'
+SCENE_DETECT_FPS = int(os.getenv('SCENE_DETECT_FPS') or 5)
+SCENE_DETECT_WIDTH = int(os.getenv('SCENE_DETECT_WIDTH') or 320)
+# adds an audio only rendition to the HLS master playlist
+ENCODE_AUDIO_ONLY = (os.getenv('ENCODE_AUDIO_ONLY') or 'false').lower() == 'true'
+# times a failed or timed out encode job is queued again, it resumes from its last completed stage
+ENCODE_RETRIES = int(os.getenv('ENCODE_RETRIES') or 3)
+# sources already encoded as the rendition would be, h264 at its resolution and
+# bitrate with keyframes at most ENCODE_PASSTHROUGH_MAX_GOP seconds apart, are
+# remuxed instead, along with their audio when it is aac
+ENCODE_PASSTHROUGH = (os.getenv('ENCODE_PASSTHROUGH') or 'true').lower() == 'true'
+ENCODE_PASSTHROUGH_MAX_GOP = float(os.getenv('ENCODE_PASSTHROUGH_MAX_GOP') or 4)
+# seconds an encode may be shorter than its source before it is repaired
+ENCODE_DURATION_TOLERANCE = float(os.getenv('ENCODE_DURATION_TOLERANCE') or 1)
+# least seconds between the encode progress updates sent to the backend
+ENCODE_PROGRESS_INTERVAL = float(os.getenv('ENCODE_PROGRESS_INTERVAL') or 10)
+# frames compared to pick a thumbnail
+THUMBNAIL_CANDIDATES = int(os.getenv('THUMBNAIL_CANDIDATES') or 8)
+# thumbnail derivatives are written as jpg, along with copies in these other formats,
+# e.g. 'webp,avif', named the same but for their extension
+THUMBNAIL_FORMATS = [f.strip() for f in (os.getenv('THUMBNAIL_FORMATS') or '').split(',') if f.strip()]
+THUMBNAIL_JPEG_QUALITY = int(os.getenv('THUMBNAIL_JPEG_QUALITY') or 85)
+THUMBNAIL_WEBP_QUALITY = int(os.getenv('THUMBNAIL_WEBP_QUALITY') or 80)
+THUMBNAIL_AVIF_QUALITY = int(os.getenv('THUMBNAIL_AVIF_QUALITY') or 60)
+# seek preview sprite sheets of SPRITE_COLUMNS x SPRITE_ROWS tiles SPRITE_WIDTH wide, a
+# tile every SPRITE_INTERVAL seconds, listed in segments/thumbnails.vtt. 0 turns them off
+SPRITE_INTERVAL = float(os.getenv('SPRITE_INTERVAL') or 10)
+SPRITE_WIDTH = int(os.getenv('SPRITE_WIDTH') or 160)
+SPRITE_COLUMNS = int(os.getenv('SPRITE_COLUMNS') or 10)
+SPRITE_ROWS = int(os.getenv('SPRITE_ROWS') or 10)
+
 # disk config
 DISK_PATH = '/'
 MAX_STORAGE_LIMIT_PERCENTAGE = os.getenv('MAX_STORAGE_LIMIT_PERCENTAGE') or 90
@@ -30,6 +102,13 @@ TWITTER_ACCESS_TOKEN_SECRET = os.getenv('TWITTER_ACCESS_TOKEN_SECRET') or ''
 # ipfs api config
 IPFS_API_HOST = os.getenv('IPFS_API_HOST') or '127.0.0.1'
 IPFS_API_PORT = os.getenv('IPFS_API_PORT') or 5001
+IPFS_API_TIMEOUT = float(os.getenv('IPFS_API_TIMEOUT') or 10)
+# seconds the ipfs node may take to answer an add or a pin
+IPFS_ADD_TIMEOUT = float(os.getenv('IPFS_ADD_TIMEOUT') or 600)
+IPFS_POOL_SIZE = int(os.getenv('IPFS_POOL_SIZE') or 10)
+# adds files by reference to the filestore instead of copying them into the blockstore.
+# Needs `ipfs config --json Experimental.FilestoreEnabled true` and the files must stay in place
+IPFS_NOCOPY = (os.getenv('IPFS_NOCOPY') or 'false').lower() == 'true'
 
 # Redis Queue config
 REDIS_HOST = os.getenv('REDIS_HOST') or '127.0.0.1'
@@ -38,4 +117,6 @@ REDIS_PORT = os.getenv('REDIS_PORT') or 6379
 # supported file formats
 ALLOWED_FILE_EXTENSIONS = {'mp4', 'mov', 'webm', 'mp3', 'm4a', 'wav', 'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'webp'}
 ALLOWED_FILE_FORMATS = ['video', 'audio', 'image', 'raster-image', 'raw-image', 'document', 'vector-image']
-MAX_FILE_UPLOAD_SIZE = os.getenv('MAX_FILE_UPLOAD_SIZE') or 500 * 1024 * 1024
\ No newline at end of file
+MAX_FILE_UPLOAD_SIZE = os.getenv('MAX_FILE_UPLOAD_SIZE') or 500 * 1024 * 1024
+# seconds after which a resumable upload no chunk was written to is removed
+UPLOAD_SESSION_TTL = int(os.getenv('UPLOAD_SESSION_TTL') or 24 * 3600)
\ No newline at end of file
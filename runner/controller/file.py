@@ -1,21 +1,29 @@
 # coding: utf-8
+import hashlib
 import json
 import os
 import mimetypes
 import shutil
+import sqlite3
 import time
-from rq import Queue
+from rq import Queue, Retry
 from redis import Redis
 from werkzeug.utils import secure_filename
 from pathlib import Path
 
 from falcon import HTTP_200, HTTP_201, HTTP_400, HTTP_404, HTTP_500, HTTP_409, HTTPBadRequest, HTTPInternalServerError
-from ..utils.file import media_files, get_disk_usage, file_type, gen_random_id, media_file
-from ..utils import ipfs
+from ..utils.file import get_disk_usage, file_type, gen_random_id, media_file, media_root, \
+    unique_file_path, is_valid_user_id
+from ..utils.multipart import MultipartReader, get_boundary
+from ..utils import ipfs, index
+from ..utils.download import send_file
+from ..utils.manifest import clear_manifest
 from ..config import ROOT_DIRECTORY, DISK_PATH, MAX_STORAGE_LIMIT_PERCENTAGE, \
-    ALLOWED_FILE_FORMATS, ALLOWED_FILE_EXTENSIONS, MAX_FILE_UPLOAD_SIZE, REDIS_HOST, REDIS_PORT, STREAM_CONFIG_FILE
+    ALLOWED_FILE_FORMATS, ALLOWED_FILE_EXTENSIONS, MAX_FILE_UPLOAD_SIZE, REDIS_HOST, REDIS_PORT, STREAM_CONFIG_FILE, \
+    ENCODE_RETRIES
+from ..lib.ffmpeg import encode_job_timeout
 from ..lib.twitter import Twitter
-from ..client.file import update_asset, get_root_path, add_asset
+from ..client.file import batch_updates, update_asset, get_root_path, add_asset
 from ..hooks import twitter, studio, youtube
 from ..scripts import add_tweet_to_tweet_video_generation_queue
 
@@ -23,22 +31,65 @@ from ..scripts import add_tweet_to_tweet_video_generation_queue
 q = Queue(connection=Redis(host=REDIS_HOST, port=REDIS_PORT))
 
 
+def stream_files(files, limit=None):
+    """Serialises the listing response one file at a time.
+
+    With a `limit`, `next` is the cursor of the following page, or null on the last one.
+    """
+    count = 0
+    last = None
+    try:
+        yield b'{"success": true, "result": ['
+        for file in files:
+            if limit and count == limit:
+                yield '], "next": {}}}'.format(json.dumps(last)).encode('utf-8')
+                return
+            yield ((', ' if count else '') + json.dumps(file)).encode('utf-8')
+            last = os.path.join(file['path'], file['name'])
+            count += 1
+        yield b'], "next": null}'
+    finally:
+        files.close()
+
+
 class AssetFiles:
     def on_get(self, req, res, userid):
+        """
+        @api {GET} /runner/users/{userid}/files 1.List Files
+        @apiDescription lists the files in the user's sources, ordered by path.
+        @apiName AssetFiles
+        @apiGroup File
+        @apiParam {String} [files] Comma separated paths to leave out.
+        @apiParam {Number} [limit] Page size, all files are returned without it.
+        @apiParam {String} [cursor] `next` value of the previous page.
+        @apiParam {String} [mime] MIME type, e.g. `video/mp4`.
+        @apiParam {String} [type] Top-level MIME type, e.g. `video`.
+        @apiParam {String} [path] Directory to list, including its subdirectories.
+        @apiSuccess {Boolean} success Success key.
+        @apiSuccess {Object[]} result Files.
+        @apiSuccess {String} next Cursor of the next page, null on the last one.
+        """
         root_path = get_root_path(userid)
-        if root_path:
-            path = os.path.join(root_path, 'media-node-data', 'sources')
-        else:
-            path = os.path.join(ROOT_DIRECTORY, 'sources')
-
         files_list = req.params.get('files').split(',') if 'files' in req.params else []
-        files = media_files(path, files_list)
+        limit = req.get_param_as_int('limit', min_value=1)
+        cursor = req.get_param('cursor')
+        # pages after the first one read the index as synced by the first
+        try:
+            files = index.iter_media(media_root(root_path), files_list, cursor=cursor, mime=req.get_param('mime'),
+                                     _type=req.get_param('type'), prefix=req.get_param('path'), sync=not cursor)
+        except (OSError, sqlite3.Error) as e:
+            # failed before anything is streamed, the response can still tell
+            print(e)
+            res.status = HTTP_500
+            res.body = json.dumps({
+                'success': False,
+                'message': 'Error while listing files.'
+            })
+            return
 
         res.status = HTTP_200
-        res.body = json.dumps({
-            'success': True,
-            'result': files
-        })
+        res.content_type = 'application/json'
+        res.stream = stream_files(files, limit)
 
 
 class AddAssetFile:
@@ -142,8 +193,10 @@ class AssetFileDelete:
                     file = os.path.join(root_path, 'media-node-data', 'sources/{0}'.format(source_path))
                 else:
                     file = os.path.join(ROOT_DIRECTORY, 'sources/{0}'.format(source_path))
-                if os.path.exists(file):
+                # identical uploads share one source file
+                if os.path.exists(file) and index.release_file(media_root(root_path), file, asset_id) == 0:
                     os.remove(file)
+                    index.remove_media(media_root(root_path), file)
             res.status = HTTP_200
             res.body = json.dumps({
                 'success': True
@@ -183,13 +236,7 @@ class AssetFileDownload:
 
         c_type = self.guess_type(file_path)
         try:
-            f = open(file_path, 'rb')
-            f.seek(0)
-            res.status = HTTP_200
-            res.set_header("Content-type", c_type)
-            fs = os.fstat(f.fileno())
-            res.set_header("Content-Length", str(fs[6]))
-            res.stream = f
+            send_file(req, res, file_path, c_type)
 
         except IOError:
             res.status = HTTP_404
@@ -210,94 +257,218 @@ def is_allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_FILE_EXTENSIONS
 
 
+def studio_storage_path(root_path, _type):
+    if not _type:
+        return None
+    if _type not in ALLOWED_FILE_FORMATS:
+        print(_type, 'type is not allowed')
+        raise HTTPBadRequest('unsupported type')
+    return os.path.join(media_root(root_path), 'sources/studio/{}'.format(_type))
+
+
+def receive_upload(req, root_path, get_storage_path):
+    """Streams the multipart body of `req`, writing the `file` part straight to disk.
+
+    The file is written as `<path>~` inside `get_storage_path(fields)`, where `fields`
+    are the form fields received before it, or inside the `uploads` spool directory
+    when that's not known yet. Returns the form fields and the upload details.
+    """
+    boundary = get_boundary(req.content_type)
+    if boundary is None:
+        raise HTTPBadRequest('multipart/form-data body is required.')
+
+    fields, upload = dict(req.params), None
+    try:
+        for part in MultipartReader(req.bounded_stream, boundary):
+            if part.filename is None:
+                fields[part.name] = part.value()
+                continue
+            if part.name != 'file' or upload is not None:
+                continue
+
+            filename = secure_filename(part.filename)
+            if not is_allowed_file(filename):
+                raise HTTPBadRequest('Invalid file type', f'Allowed file types are: {", ".join(ALLOWED_FILE_EXTENSIONS)}')
+
+            storage_path = get_storage_path(fields) or os.path.join(media_root(root_path), 'uploads')
+            if not os.path.exists(storage_path):
+                os.makedirs(storage_path)
+            file_path = unique_file_path(storage_path, filename)
+            upload = {
+                'filename': filename,
+                'path': file_path,
+                'temp_path': file_path + '~',
+            }
+            sha256 = hashlib.sha256()
+            upload['size'] = part.save(upload['temp_path'], on_chunk=sha256.update)
+            upload['digest'] = sha256.hexdigest()
+    except ValueError as e:
+        discard_upload(upload)
+        raise HTTPBadRequest('Error parsing file', str(e))
+    except Exception:
+        discard_upload(upload)
+        raise
+
+    return fields, upload
+
+
+def complete_upload(upload, storage_path):
+    """Moves a received upload to its final name inside `storage_path`, returns the file path."""
+    file_path = upload['path']
+    if os.path.dirname(file_path) != storage_path:
+        if not os.path.exists(storage_path):
+            os.makedirs(storage_path)
+        file_path = unique_file_path(storage_path, upload['filename'])
+    os.rename(upload['temp_path'], file_path)
+    upload['path'] = file_path
+    return file_path
+
+
+def discard_upload(upload):
+    if upload is None:
+        return
+    for path in (upload['temp_path'], upload['path']):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def find_duplicate(media_path, file_path, digest):
+    """Returns the stored file identical to the upload at `file_path`, which is then removed."""
+    duplicate = index.find_file(media_path, digest)
+    if duplicate is None or duplicate['path'] == index.normalize_path(file_path):
+        return None
+    print('file is a duplicate of', duplicate['path'], ', removing', file_path)
+    os.remove(file_path)
+    return duplicate
+
+
+def index_uploaded_file(media_path, file_path, asset_id, digest, duplicate):
+    if not digest:
+        return
+    if duplicate is None:
+        index.add_file(media_path, digest, file_path, asset_id)
+    else:
+        index.add_asset(media_path, digest, asset_id)
+
+
+def enqueue_uploaded_file(file_path, asset_id, root_path, digest, duplicate):
+    # TODO: recheck
+    # Add file to processing queue
+    if duplicate is not None and duplicate['result']:
+        q.enqueue(studio.duplicate_file_hook, file_path, asset_id, duplicate['assetId'], duplicate['result'],
+                  root_path=root_path, digest=digest, job_timeout=1200, retry=Retry(max=ENCODE_RETRIES))
+    else:
+        q.enqueue(studio.asset_file_upload_complete_hook, file_path, asset_id, segment_duration=900, root_path=root_path,
+                  digest=digest, job_timeout=encode_job_timeout(file_path, 1200), retry=Retry(max=ENCODE_RETRIES))
+
+
+def asset_file_uploaded(asset_id, root_path, file_path, _type, digest=None):
+    """Attaches an uploaded file to an existing asset, adds it to ipfs and queues its processing.
+
+    Uploads whose sha256 `digest` matches a stored file reuse that file and the
+    results of its processing.
+    """
+    media_path = media_root(root_path)
+    duplicate = find_duplicate(media_path, file_path, digest)
+    if duplicate is not None:
+        file_path = duplicate['path']
+    filename = os.path.basename(file_path)
+    download_path = os.path.relpath(os.path.dirname(file_path), os.path.join(media_path, 'sources'))
+    print('file upload completed ... ')
+    print('file saved at', file_path)
+
+    duration = 0
+    if _type == 'video':
+        info = media_file(file_path)
+        print('info: ', info)
+        if info is not None:
+            duration = info['duration']
+    # updating asset
+    update_asset(asset_id, {'file': {'name': filename, 'status': 'PROCESSING'}, 'downloadPath':  download_path, 'duration': duration})
+    with batch_updates():
+        ipfs_hash = None
+        if duplicate is not None and duplicate['result']:
+            ipfs_hash = duplicate['result'].get('file', {}).get('IPFSHash')
+        if ipfs_hash is None:
+            ipfs_hash = ipfs.add_file(file_path)
+            if ipfs_hash is not None:
+                pinned = ipfs.pin_file(ipfs_hash)
+                if not pinned:
+                    update_asset(asset_id, {'file': {'status': 'IPFS_PIN_FAILED'}})
+        if ipfs_hash is not None:
+            update_asset(asset_id, {'file': {'IPFSHash': ipfs_hash, 'previewIPFSHash': ipfs_hash, 'status': 'COMPLETE'}})
+        else:
+            update_asset(asset_id, {'file': {'status': 'IPFS_PIN_FAILED'}})
+
+    index_uploaded_file(media_path, file_path, asset_id, digest, duplicate)
+    enqueue_uploaded_file(file_path, asset_id, root_path, digest, duplicate)
+
+
+def studio_file_uploaded(userid, root_path, file_path, _type, digest=None):
+    """Adds a new studio asset for an uploaded file and queues its processing.
+
+    Uploads whose sha256 `digest` matches a stored file reuse that file and the
+    results of its processing.
+    """
+    media_path = media_root(root_path)
+    duplicate = find_duplicate(media_path, file_path, digest)
+    if duplicate is not None:
+        file_path = duplicate['path']
+    filename = os.path.basename(file_path)
+    file_data = {
+        'name': filename,
+        'path': os.path.relpath(os.path.dirname(file_path), os.path.join(media_path, 'sources')),
+        'source': 'studio',
+        'MIMEType': _type,
+    }
+    data = {
+        'name': filename,
+        'file': file_data,
+        'userId': userid,
+    }
+
+    success, result = add_asset(data)
+    if not success:
+        raise HTTPBadRequest('Error while adding asset', 'Error while adding asset')
+
+    print('file upload completed ... ')
+    print('file saved at', file_path)
+    update_asset(result['_id'], {'file': {'status': 'COMPLETE'}})
+
+    index_uploaded_file(media_path, file_path, result['_id'], digest, duplicate)
+    enqueue_uploaded_file(file_path, result['_id'], root_path, digest, duplicate)
+    return result
+
+
 class AssetFileUpload:
     cors_enabled = False
+    multipart_streaming = True
 
     def on_post(self, req, res, userid, asset_id):
+        upload = None
         try:
-            _type = req.get_param('_type')
-            print('file type: ', _type)
-            uploaded_file = req.get_param('file')
-
             root_path = get_root_path(userid)
             print('root path: ', root_path)
 
-            if not _type or uploaded_file is None or not uploaded_file.file:
-                raise HTTPBadRequest('\'_type\' and \'file\' are required parameters.')
+            disk_used = get_disk_usage(DISK_PATH)
+            if disk_used and disk_used > MAX_STORAGE_LIMIT_PERCENTAGE:
+                raise HTTPInternalServerError('no storage', 'maximum storage limit is exceeded.')
 
-            if not _type:
-                raise HTTPBadRequest('\'_type\' is required parameter.')
+            fields, upload = receive_upload(req, root_path,
+                                            lambda fields: studio_storage_path(root_path, fields.get('_type')))
+            _type = fields.get('_type')
+            print('file type: ', _type)
 
-            uploaded_file = req.get_param('file')
-            if uploaded_file is None:
-                raise HTTPBadRequest("Missing file", "Please upload a file.")
+            if not _type or upload is None:
+                raise HTTPBadRequest('\'_type\' and \'file\' are required parameters.')
 
             # Check if the uploaded file exceeds the maximum size
             '''
-            if uploaded_file.content_length > MAX_FILE_UPLOAD_SIZE:
+            if upload['size'] > MAX_FILE_UPLOAD_SIZE:
                 raise HTTPBadRequest("File too large", f"Maximum file size allowed is {MAX_FILE_UPLOAD_SIZE} bytes.")
             '''
-            filename = secure_filename(uploaded_file.filename)
-
-            if not is_allowed_file(filename):
-                raise HTTPBadRequest('Invalid file type', f'Allowed file types are: {", ".join(ALLOWED_FILE_EXTENSIONS)}')
-
-            if _type not in ALLOWED_FILE_FORMATS:
-                print(_type, 'type is not allowed')
-                raise HTTPBadRequest('unsupported type')
-
-            disk_used = get_disk_usage(DISK_PATH)
-            if disk_used and disk_used > MAX_STORAGE_LIMIT_PERCENTAGE:
-                raise HTTPInternalServerError('no storage', 'maximum storage limit is exceeded.')
-
-            if root_path:
-                _storage_path = os.path.join(root_path, 'media-node-data', 'sources/studio/{}'.format(_type))
-            else:
-                _storage_path = os.path.join(ROOT_DIRECTORY, 'sources/studio/{}'.format(_type))
-            if not os.path.exists(_storage_path):
-                os.makedirs(_storage_path)
-
-            file_path = os.path.join(_storage_path, filename)
-
-            count = 1
-            temp_filename = None
-            while os.path.exists(file_path):
-                temp_filename = '{}_{}.{}'.format(filename.rsplit('.')[0], count, filename.rsplit('.')[1])
-                file_path = os.path.join(_storage_path, temp_filename)
-                count += 1
-            if temp_filename is not None:
-                filename = temp_filename
-
-            with open(file_path, 'wb') as f:
-                while True:
-                    chunk = uploaded_file.file.read(104857600)  # 10MB chunk size
-                    if not chunk:
-                        break
-                    f.write(chunk)
-
-            print('file upload completed ... ')
-            print('file saved at', file_path)
-
-            duration = 0
-            if _type == 'video':
-                info = media_file(file_path)
-                print('info: ', info)
-                if info is not None:
-                    duration = info['duration']
-            # updating asset
-            update_asset(asset_id, {'file': {'name': filename, 'status': 'PROCESSING'}, 'downloadPath':  'studio/{}'.format(_type), 'duration': duration})
-            ipfs_hash = ipfs.add_file(file_path)
-            if ipfs_hash is not None:
-                pinned = ipfs.pin_file(ipfs_hash)
-                if not pinned:
-                    update_asset(asset_id, {'file': {'status': 'IPFS_PIN_FAILED'}})
-                update_asset(asset_id, {'file': {'IPFSHash': ipfs_hash, 'previewIPFSHash': ipfs_hash, 'status': 'COMPLETE'}})
-
-            else:
-                update_asset(asset_id, {'file': {'status': 'IPFS_PIN_FAILED'}})
-            # TODO: recheck
-            # Add file to processing queue
-            q.enqueue(studio.asset_file_upload_complete_hook, file_path, asset_id, segment_duration=900, root_path=root_path, job_timeout=1200)
+            file_path = complete_upload(upload, studio_storage_path(root_path, _type))
+            asset_file_uploaded(asset_id, root_path, file_path, _type, upload['digest'])
 
             res.status = HTTP_201
             res.body = json.dumps({
@@ -306,6 +477,7 @@ class AssetFileUpload:
             })
         except HTTPBadRequest as e:
             print(e)
+            discard_upload(upload)
             res.status = HTTP_400
             res.body = json.dumps({
                 'success': False,
@@ -316,6 +488,8 @@ class AssetFileUpload:
 
         except Exception as e:
             print(e)
+            # the upload is only kept once its processing is queued
+            discard_upload(upload)
             res.status = HTTP_500
             res.body = json.dumps({
                 'success': False,
@@ -365,7 +539,11 @@ class AssetFileEncode:
             })
         else:
             try:
-                q.enqueue(studio.file_encode_hook, file_path, asset_id, root_path, job_timeout=600)
+                # encoded again from the start, only the retries of the job resume it
+                clear_manifest(os.path.join(media_root(root_path), 'assets', asset_id))
+                q.enqueue(studio.file_encode_hook, file_path, asset_id, root_path,
+                          job_timeout=encode_job_timeout(file_path, 600),
+                          retry=Retry(max=ENCODE_RETRIES))
                 res.status = HTTP_200
                 res.body = json.dumps({
                     'success': True,
@@ -382,6 +560,50 @@ class AssetFileEncode:
                 })
 
 
+def invalid_id(res):
+    res.status = HTTP_400
+    res.body = json.dumps({
+        'success': False,
+        'message': 'invalid id.'
+    })
+
+
+def read_progress(progress_file, res):
+    try:
+        with open(progress_file, 'r') as f:
+            progress = json.load(f)
+    except (OSError, ValueError):
+        res.status = HTTP_404
+        res.body = json.dumps({
+            'success': False,
+            'message': 'encode progress not found.'
+        })
+        return
+    res.status = HTTP_200
+    res.body = json.dumps({
+        'success': True,
+        'result': progress,
+    })
+
+
+class AssetFileEncodeProgress:
+    def on_get(self, req, res, userid, asset_id):
+        """
+        @api {GET} /runner/users/{userid}/assets/{asset_id}/encode-progress 2.Encode Progress
+        @apiDescription returns the progress of the asset's latest encode.
+        @apiName AssetFileEncodeProgress
+        @apiGroup File
+        @apiSuccess {Boolean} success Success key.
+        @apiSuccess {Object} result Status, progress in percent, speed and eta of the encode and of each rendition.
+        """
+        # both end up in paths
+        if not is_valid_user_id(userid) or not is_valid_user_id(asset_id):
+            invalid_id(res)
+            return
+        root_path = get_root_path(userid)
+        read_progress(os.path.join(media_root(root_path), 'assets', asset_id, 'progress.json'), res)
+
+
 class UploadAssetThumbnail:
     def on_post(self, req, res, userid):
         try:
@@ -447,89 +669,38 @@ class UploadAssetThumbnail:
 
 class FileUpload:
     cors_enabled = False
+    multipart_streaming = True
 
     def on_post(self, req, res, userid):
+        upload = None
         try:
             print(time.time(), 'upload ...')
-            _type = req.get_param('_type')
-            print('file_type: ', _type)
-
             root_path = get_root_path(userid)
             print('root path: ', root_path)
 
+            disk_used = get_disk_usage(DISK_PATH)
+            if disk_used and disk_used > MAX_STORAGE_LIMIT_PERCENTAGE:
+                raise HTTPInternalServerError('no storage', 'maximum storage limit is exceeded.')
+
+            fields, upload = receive_upload(req, root_path,
+                                            lambda fields: studio_storage_path(root_path, fields.get('_type')))
+            _type = fields.get('_type')
+            print('file_type: ', _type)
+
             if not _type:
                 raise HTTPBadRequest('\'_type\' is required parameter.')
 
-            uploaded_file = req.get_param('file')
-            if uploaded_file is None:
+            if upload is None:
                 raise HTTPBadRequest("Missing file", "Please upload a file.")
 
             # Check if the uploaded file exceeds the maximum size
             '''
-            if uploaded_file.content_length > MAX_FILE_UPLOAD_SIZE:
+            if upload['size'] > MAX_FILE_UPLOAD_SIZE:
                 raise HTTPBadRequest("File too large", f"Maximum file size allowed is {MAX_FILE_UPLOAD_SIZE} bytes.")
             '''
-            filename = secure_filename(uploaded_file.filename)
-
-            if not is_allowed_file(filename):
-                raise HTTPBadRequest('Invalid file type', f'Allowed file types are: {", ".join(ALLOWED_FILE_EXTENSIONS)}')
-
-            if _type not in ALLOWED_FILE_FORMATS:
-                print(_type, 'type is not allowed')
-                raise HTTPBadRequest('unsupported type')
-
-            disk_used = get_disk_usage(DISK_PATH)
-            if disk_used and disk_used > MAX_STORAGE_LIMIT_PERCENTAGE:
-                raise HTTPInternalServerError('no storage', 'maximum storage limit is exceeded.')
-
-            if root_path:
-                _storage_path = os.path.join(root_path, 'media-node-data', 'sources/studio/{}'.format(_type))
-            else:
-                _storage_path = os.path.join(ROOT_DIRECTORY, 'sources/studio/{}'.format(_type))
-            if not os.path.exists(_storage_path):
-                os.makedirs(_storage_path)
-
-            file_path = os.path.join(_storage_path, filename)
-
-            count = 1
-            temp_filename = None
-            while os.path.exists(file_path):
-                temp_filename = '{}_{}.{}'.format(filename.rsplit('.')[0], count, filename.rsplit('.')[1])
-                file_path = os.path.join(_storage_path, temp_filename)
-                count += 1
-
-            if temp_filename is not None:
-                filename = temp_filename
-            file_data = {
-                'name': filename,
-                'path': 'studio/{}'.format(_type),
-                'source': 'studio',
-                'MIMEType': _type,
-            }
-            data = {
-                'name': filename,
-                'file': file_data,
-                'userId': userid,
-            }
-
-            success, result = add_asset(data)
-            if not success:
-                raise HTTPBadRequest('Error while adding asset', 'Error while adding asset')
-
-            with open(file_path, 'wb') as f:
-                while True:
-                    chunk = uploaded_file.file.read(104857600)  # 10MB chunk size
-                    if not chunk:
-                        break
-                    f.write(chunk)
+            file_path = complete_upload(upload, studio_storage_path(root_path, _type))
+            studio_file_uploaded(userid, root_path, file_path, _type, upload['digest'])
 
-            print('file upload completed ... ')
-            print('file saved at', file_path)
-            update_asset(result['_id'], {'file': {'status': 'COMPLETE'}})
-
-            # Add file processing to queue
-            # TODO: recheck
-            q.enqueue(studio.asset_file_upload_complete_hook, file_path, result['_id'], segment_duration=900, root_path=root_path, job_timeout=1200)
             res.status = HTTP_201
             res.body = json.dumps({
                 'success': True,
@@ -538,6 +709,7 @@ class FileUpload:
 
         except HTTPBadRequest as e:
             print(e)
+            discard_upload(upload)
             res.status = HTTP_400
             res.body = json.dumps({
                 'success': False,
@@ -547,6 +719,8 @@ class FileUpload:
             })
         except Exception as e:
             print(e)
+            # the upload is only kept once its processing is queued
+            discard_upload(upload)
             res.status = HTTP_500
             res.body = json.dumps({
                 'success': False,
@@ -623,61 +797,37 @@ class AllowedFileTypes:
 
 
 class AddDefaultStream:
+    multipart_streaming = True
+
     def on_post(self, req, res, userid):
+        upload = None
         try:
             print(time.time(), 'upload ...')
-            _type = req.get_param('_type')
-            print('file_type: ', _type)
-
             root_path = get_root_path(userid)
             print('root path: ', root_path)
 
-            if not _type:
-                raise HTTPBadRequest('\'_type\' is required parameter.')
-
-            uploaded_file = req.get_param('file')
-            if uploaded_file is None:
-                raise HTTPBadRequest("Missing file", "Please upload a file.")
-
-            # Check if the uploaded file exceeds the maximum size
-            '''
-            if uploaded_file.content_length > MAX_FILE_UPLOAD_SIZE:
-                raise HTTPBadRequest("File too large", f"Maximum file size allowed is {MAX_FILE_UPLOAD_SIZE} bytes.")
-            '''
-            filename = secure_filename(uploaded_file.filename)
-
-            if not is_allowed_file(filename):
-                raise HTTPBadRequest('Invalid file type', f'Allowed file types are: {", ".join(ALLOWED_FILE_EXTENSIONS)}')
-
-            if _type != 'video':
-                print(_type, 'type is not allowed for default stream')
-                raise HTTPBadRequest('unsupported type')
-
             disk_used = get_disk_usage(DISK_PATH)
             if disk_used and disk_used > MAX_STORAGE_LIMIT_PERCENTAGE:
                 raise HTTPInternalServerError('no storage', 'maximum storage limit is exceeded.')
 
-            if root_path:
-                _storage_path = os.path.join(root_path, 'media-node-data')
-            else:
-                _storage_path = os.path.join(ROOT_DIRECTORY)
-            if not os.path.exists(_storage_path):
-                os.makedirs(_storage_path)
+            def get_storage_path(fields):
+                if fields.get('_type') and fields['_type'] != 'video':
+                    print(fields['_type'], 'type is not allowed for default stream')
+                    raise HTTPBadRequest('unsupported type')
+                return media_root(root_path)
 
-            file_path = os.path.join(_storage_path, filename)
+            fields, upload = receive_upload(req, root_path, get_storage_path)
+            _type = fields.get('_type')
+            print('file_type: ', _type)
 
-            count = 1
-            while os.path.exists(file_path):
-                temp_filename = '{}_{}.{}'.format(filename.rsplit('.', 1)[0], count, filename.rsplit('.', 1)[1])
-                file_path = os.path.join(_storage_path, temp_filename)
-                count += 1
+            if not _type:
+                raise HTTPBadRequest('\'_type\' is required parameter.')
 
-            with open(file_path, 'wb') as f:
-                while True:
-                    chunk = uploaded_file.file.read(104857600)  # 10MB chunk size
-                    if not chunk:
-                        break
-                    f.write(chunk)
+            if upload is None:
+                raise HTTPBadRequest("Missing file", "Please upload a file.")
+
+            get_storage_path(fields)
+            file_path = complete_upload(upload, media_root(root_path))
 
             print('file upload completed ... ')
             print('file saved at', file_path)
@@ -701,6 +851,7 @@ class AddDefaultStream:
 
         except HTTPBadRequest as e:
             print(e)
+            discard_upload(upload)
             res.status = HTTP_400
             res.body = json.dumps({
                 'success': False,
@@ -710,6 +861,8 @@ class AddDefaultStream:
             })
         except Exception as e:
             print(e)
+            # the upload is only kept once its processing is queued
+            discard_upload(upload)
             res.status = HTTP_500
             res.body = json.dumps({
                 'success': False,
@@ -718,6 +871,23 @@ class AddDefaultStream:
                 }
             })
 
+class DefaultStreamProgress:
+    def on_get(self, req, res, userid):
+        """
+        @api {GET} /runner/users/{userid}/default-stream-progress 3.Default Stream Encode Progress
+        @apiDescription returns the progress of the default stream's latest encode.
+        @apiName DefaultStreamProgress
+        @apiGroup File
+        @apiSuccess {Boolean} success Success key.
+        @apiSuccess {Object} result Status, progress in percent, speed and eta of the encode.
+        """
+        if not is_valid_user_id(userid):
+            invalid_id(res)
+            return
+        root_path = get_root_path(userid)
+        read_progress(os.path.join(media_root(root_path), 'default_progress.json'), res)
+
+
 class GetDefaultStream:
     def on_get(self, req, res, userid):
         root_path = get_root_path(userid)
@@ -728,13 +898,7 @@ class GetDefaultStream:
 
         c_type = self.guess_type(file_path)
         try:
-            f = open(file_path, 'rb')
-            f.seek(0)
-            res.status = HTTP_200
-            res.set_header("Content-type", c_type)
-            fs = os.fstat(f.fileno())
-            res.set_header("Content-Length", str(fs[6]))
-            res.stream = f
+            send_file(req, res, file_path, c_type)
 
         except IOError:
             res.status = HTTP_404
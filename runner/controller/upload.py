@@ -0,0 +1,247 @@
+# coding: utf-8
+import json
+import os
+from werkzeug.utils import secure_filename
+
+from falcon import HTTP_200, HTTP_201, HTTP_400, HTTP_404, HTTP_409, HTTP_500, HTTPBadRequest, \
+    HTTPInternalServerError, HTTPNotFound, HTTPConflict
+from ..utils.file import get_disk_usage, get_free_space, unique_file_path
+from ..utils.upload import UploadSession, sweep_sessions, uploads_path
+from ..config import DISK_PATH, MAX_STORAGE_LIMIT_PERCENTAGE, ALLOWED_FILE_EXTENSIONS
+from ..client.file import get_root_path
+from .file import is_allowed_file, studio_storage_path, asset_file_uploaded, studio_file_uploaded
+
+
+def get_session(userid, upload_id):
+    root_path = get_root_path(userid)
+    try:
+        session = UploadSession(root_path, upload_id)
+    except ValueError:
+        raise HTTPNotFound()
+    if not session.exists():
+        raise HTTPNotFound()
+    status = session.status()
+    if status['userId'] != userid:
+        raise HTTPNotFound()
+    return root_path, session, status
+
+
+def error_response(res, status, message):
+    res.status = status
+    res.body = json.dumps({
+        'success': False,
+        'error': {
+            'message': message
+        }
+    })
+
+
+def session_result(status):
+    return {
+        'uploadId': status['uploadId'],
+        'assetId': status['assetId'],
+        'filename': status['filename'],
+        'size': status['size'],
+        'offset': status['offset'],
+        'bytesReceived': status['bytesReceived'],
+        'received': status['received'],
+        'complete': status['complete'],
+    }
+
+
+class Uploads:
+    def on_post(self, req, res, userid):
+        """
+        @api {POST} /runner/users/{userid}/uploads 1.Create Upload
+        @apiDescription starts a resumable upload, chunks are sent with PUT.
+        @apiName UploadCreate
+        @apiGroup Upload
+        @apiParam {String} filename File name.
+        @apiParam {String} _type File type.
+        @apiParam {Number} size File size in bytes.
+        @apiParam {String} [assetId] Asset to attach the file to, a new asset is added otherwise.
+        @apiSuccess {Boolean} success Success key.
+        @apiSuccess {Object} result Upload status.
+        """
+        try:
+            media = req.media or {}
+            filename = secure_filename(media.get('filename') or '')
+            _type = media.get('_type')
+            size = media.get('size')
+            asset_id = media.get('assetId')
+
+            if not filename or not _type or not isinstance(size, int) or size <= 0:
+                raise HTTPBadRequest('\'filename\', \'_type\' and \'size\' are required parameters.')
+
+            if not is_allowed_file(filename):
+                raise HTTPBadRequest('Invalid file type', f'Allowed file types are: {", ".join(ALLOWED_FILE_EXTENSIONS)}')
+
+            studio_storage_path(None, _type)
+
+            disk_used = get_disk_usage(DISK_PATH)
+            if disk_used and disk_used > MAX_STORAGE_LIMIT_PERCENTAGE:
+                raise HTTPInternalServerError('no storage', 'maximum storage limit is exceeded.')
+
+            root_path = get_root_path(userid)
+            # the parts are preallocated sparse, the space other uploads are still to fill is taken too
+            pending = sweep_sessions(uploads_path(root_path))
+            if size + pending > get_free_space(DISK_PATH):
+                raise HTTPBadRequest('no storage', 'not enough free space for the upload.')
+            session = UploadSession.create(root_path, userid, filename, _type, size, asset_id)
+
+            res.status = HTTP_201
+            res.body = json.dumps({
+                'success': True,
+                'result': session_result(session.status()),
+            })
+        except HTTPBadRequest as e:
+            print(e)
+            error_response(res, HTTP_400, str(e))
+        except Exception as e:
+            print(e)
+            error_response(res, HTTP_500, 'internal server error')
+
+
+class Upload:
+    def on_get(self, req, res, userid, upload_id):
+        """
+        @api {GET} /runner/users/{userid}/uploads/{upload_id} 2.Upload Status
+        @apiDescription returns the received byte ranges of an upload.
+        @apiName UploadStatus
+        @apiGroup Upload
+        @apiSuccess {Boolean} success Success key.
+        @apiSuccess {Object} result Upload status.
+        """
+        try:
+            _, _, status = get_session(userid, upload_id)
+        except HTTPNotFound:
+            error_response(res, HTTP_404, 'upload not found.')
+            return
+        res.status = HTTP_200
+        res.body = json.dumps({
+            'success': True,
+            'result': session_result(status),
+        })
+
+    def on_put(self, req, res, userid, upload_id):
+        """
+        @api {PUT} /runner/users/{userid}/uploads/{upload_id} 3.Upload Chunk
+        @apiDescription writes the request body at the given offset, chunks may be sent in parallel.
+        @apiName UploadChunk
+        @apiGroup Upload
+        @apiParam {Number} offset Byte offset of the chunk, also accepted as `Upload-Offset` header.
+        @apiSuccess {Boolean} success Success key.
+        @apiSuccess {Object} result Upload status.
+        """
+        try:
+            _, session, status = get_session(userid, upload_id)
+            offset = req.get_param_as_int('offset')
+            if offset is None and req.get_header('Upload-Offset'):
+                try:
+                    offset = int(req.get_header('Upload-Offset'))
+                except ValueError:
+                    raise HTTPBadRequest('invalid \'Upload-Offset\' header.')
+            length = req.content_length
+            if offset is None or offset < 0 or not length:
+                raise HTTPBadRequest('\'offset\' and a non empty body are required.')
+            if offset + length > status['size']:
+                raise HTTPBadRequest('chunk exceeds the upload size.')
+
+            try:
+                written = session.write_chunk(req.bounded_stream, offset, length)
+            except FileNotFoundError:
+                # completed or aborted by another request
+                raise HTTPNotFound()
+            if written != length:
+                raise HTTPBadRequest('incomplete chunk, received {} of {} bytes.'.format(written, length))
+
+            status = session.status()
+            res.status = HTTP_200
+            res.set_header('Upload-Offset', str(status['offset']))
+            res.body = json.dumps({
+                'success': True,
+                'result': session_result(status),
+            })
+        except HTTPBadRequest as e:
+            print(e)
+            error_response(res, HTTP_400, str(e))
+        except HTTPNotFound as e:
+            print(e)
+            error_response(res, HTTP_404, 'upload not found.')
+        except Exception as e:
+            print(e)
+            error_response(res, HTTP_500, 'internal server error')
+
+    def on_delete(self, req, res, userid, upload_id):
+        try:
+            _, session, _ = get_session(userid, upload_id)
+        except HTTPNotFound:
+            error_response(res, HTTP_404, 'upload not found.')
+            return
+        session.abort()
+        res.status = HTTP_200
+        res.body = json.dumps({
+            'success': True,
+        })
+
+
+class UploadFinalize:
+    def on_post(self, req, res, userid, upload_id):
+        """
+        @api {POST} /runner/users/{userid}/uploads/{upload_id}/finalize 4.Finalize Upload
+        @apiDescription moves a complete upload to the studio sources and queues its processing.
+        @apiName UploadFinalize
+        @apiGroup Upload
+        @apiSuccess {Boolean} success Success key.
+        """
+        try:
+            root_path, session, _ = get_session(userid, upload_id)
+
+            def get_file_path(status):
+                storage_path = studio_storage_path(root_path, status['_type'])
+                if not os.path.exists(storage_path):
+                    os.makedirs(storage_path)
+                return unique_file_path(storage_path, status['filename'])
+
+            try:
+                status = session.complete(get_file_path)
+            except FileNotFoundError:
+                # completed or aborted by another request
+                raise HTTPNotFound()
+            if 'path' not in status:
+                raise HTTPConflict('upload is incomplete', 'received {} of {} bytes.'.format(
+                    status['bytesReceived'], status['size']))
+            file_path, digest, _type = status['path'], status['digest'], status['_type']
+
+            try:
+                if status['assetId']:
+                    asset_file_uploaded(status['assetId'], root_path, file_path, _type, digest)
+                else:
+                    studio_file_uploaded(userid, root_path, file_path, _type, digest)
+            except HTTPBadRequest:
+                # rejected, the upload is dropped
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+                raise
+            except Exception:
+                # kept for the client to finalize again
+                session.restore(status)
+                raise
+
+            res.status = HTTP_201
+            res.body = json.dumps({
+                'success': True,
+                'message': 'file uploaded successfully.'
+            })
+        except HTTPConflict as e:
+            print(e)
+            error_response(res, HTTP_409, '{}: {}'.format(e.title, e.description))
+        except HTTPBadRequest as e:
+            print(e)
+            error_response(res, HTTP_400, str(e))
+        except HTTPNotFound as e:
+            print(e)
+            error_response(res, HTTP_404, 'upload not found.')
+        except Exception as e:
+            print(e)
+            error_response(res, HTTP_500, 'internal server error')
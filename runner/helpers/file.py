@@ -1,8 +1,64 @@
 import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
-from ..config import ROOT_DIRECTORY
+from ..config import ROOT_DIRECTORY, THUMBNAIL_FORMATS, THUMBNAIL_JPEG_QUALITY, THUMBNAIL_WEBP_QUALITY, \
+    THUMBNAIL_AVIF_QUALITY
 from ..utils.file import gen_random_id
 
+# resized copies of each thumbnail orientation, the first one is its compressed thumbnail
+THUMBNAIL_DERIVATIVES = {
+    'horizontal': [('mid-h', (711, 400)), ('low-h', (210, 119))],
+    'vertical': [('mid-v', (224, 336)), ('low-v', (147, 195))],
+    'square': [('mid-s', (300, 300)), ('low-s', (100, 100))],
+}
+SAVE_OPTIONS = {
+    'jpg': {'format': 'JPEG', 'quality': THUMBNAIL_JPEG_QUALITY, 'optimize': True, 'progressive': True},
+    'webp': {'format': 'WEBP', 'quality': THUMBNAIL_WEBP_QUALITY, 'method': 4},
+    'avif': {'format': 'AVIF', 'quality': THUMBNAIL_AVIF_QUALITY},
+}
+
+
+def decode_thumbnail(file_path, original_path, size):
+    """Writes the original thumbnail to `original_path` and returns the source decoded as RGB.
+
+    JPEGs are copied as they are, without compressing them again, and decoded
+    scaled down to no less than `size`. Other sources are decoded in full once,
+    for both.
+    """
+    with Image.open(file_path) as source:
+        copied = source.format == 'JPEG'
+        if copied:
+            shutil.copyfile(file_path, original_path)
+            source.draft('RGB', size)
+        # loaded into a new image, the source file is closed on leaving the block
+        im = source.convert('RGB')
+    if not copied:
+        im.save(original_path, **SAVE_OPTIONS['jpg'])
+    return im
+
+
+def thumbnail_formats():
+    """Extensions the derivatives are saved as, jpg then the THUMBNAIL_FORMATS this Pillow build can write."""
+    # registers the plugins, Image.SAVE is only filled in once they are
+    Image.init()
+    formats = ['jpg']
+    for ext in THUMBNAIL_FORMATS:
+        if ext in formats:
+            continue
+        if ext not in SAVE_OPTIONS or SAVE_OPTIONS[ext]['format'] not in Image.SAVE:
+            print('unsupported thumbnail format: ', ext)
+            continue
+        formats.append(ext)
+    return formats
+
+
+def save_derivative(im, size, filepath, formats):
+    im = im.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+    base = os.path.splitext(filepath)[0]
+    for ext in formats:
+        im.save('{}.{}'.format(base, ext), **SAVE_OPTIONS[ext])
+
 
 def generate_multiple_thumbnails(id, thumbnails, root_path=None):
     if root_path:
@@ -11,48 +67,27 @@ def generate_multiple_thumbnails(id, thumbnails, root_path=None):
         thumbnails_dir = os.path.join(ROOT_DIRECTORY, 'thumbnails/{}'.format(id))
     if not os.path.exists(thumbnails_dir):
         os.makedirs(thumbnails_dir)
-    data = {}
-    for key in thumbnails.keys():
-        thumbnail_file_path = thumbnails[key]
-        im = Image.open(thumbnail_file_path)
-        filename = '{}-{}-original.jpg'.format(gen_random_id(16), key)
-        filepath = os.path.join(thumbnails_dir, filename)
-        im.save(filepath)
-        ext_type = '.jpg'
-        if key == 'horizontal':
-            data['horizontalThumbnail'] = f'/thumbnails/{id}/{filename}'
-            resized_filename = '.'.join(filename.split('.')[:-1]).replace('original', 'mid-h') + ext_type
-            resized_image = os.path.join(thumbnails_dir, resized_filename)
-            im = im.resize((711, 400), Image.Resampling.LANCZOS)
-            im.save(resized_image)
-            data['horizontalCompressedThumbnail'] = f'/thumbnails/{id}/{resized_filename}'
-            resized_filename = '.'.join(filename.split('.')[:-1]).replace('original', 'low-h') + ext_type
-            resized_image = os.path.join(thumbnails_dir, resized_filename)
-            im = im.resize((210, 119), Image.Resampling.LANCZOS)
-            im.save(resized_image)
-        if key == 'vertical':
-            data['verticalThumbnail'] = f'/thumbnails/{id}/{filename}'
-            resized_filename = '.'.join(filename.split('.')[:-1]).replace('original', 'mid-v') + ext_type
-            resized_image = os.path.join(thumbnails_dir, resized_filename)
-            im = im.resize((224, 336), Image.Resampling.LANCZOS)
-            im.save(resized_image)
-            data['verticalCompressedThumbnail'] = f'/thumbnails/{id}/{resized_filename}'
-            resized_filename = '.'.join(filename.split('.')[:-1]).replace('original', 'low-v') + ext_type
-            resized_image = os.path.join(thumbnails_dir, resized_filename)
-            im = im.resize((147, 195), Image.Resampling.LANCZOS)
-            im.save(resized_image)
-        if key == 'square':
-            data['squareThumbnail'] = f'/thumbnails/{id}/{filename}'
-            resized_filename = '.'.join(filename.split('.')[:-1]).replace('original', 'mid-s') + ext_type
-            resized_image = os.path.join(thumbnails_dir, resized_filename)
-            base_size = 300
-            im = im.resize((base_size, base_size), Image.Resampling.LANCZOS)
-            im.save(resized_image)
-            data['squareCompressedThumbnail'] = f'/thumbnails/{id}/{resized_filename}'
-            resized_filename = '.'.join(filename.split('.')[:-1]).replace('original', 'low-s') + ext_type
-            resized_image = os.path.join(thumbnails_dir, resized_filename)
-            base_size = 100
-            im = im.resize((base_size, base_size), Image.Resampling.LANCZOS)
-            im.save(resized_image)
-
-        return data
+    keys = [key for key in thumbnails.keys() if key in THUMBNAIL_DERIVATIVES]
+    filenames = {key: '{}-{}-original.jpg'.format(gen_random_id(16), key) for key in keys}
+
+    def decode(key):
+        sizes = [size for _, size in THUMBNAIL_DERIVATIVES[key]]
+        # decoded once, at the size of its largest derivative
+        return decode_thumbnail(thumbnails[key], os.path.join(thumbnails_dir, filenames[key]),
+                                (max(w for w, _ in sizes), max(h for _, h in sizes)))
+
+    formats = thumbnail_formats()
+    data, jobs = {}, []
+    with ThreadPoolExecutor() as executor:
+        images = dict(zip(keys, executor.map(decode, keys)))
+        for key in keys:
+            data['{}Thumbnail'.format(key)] = f'/thumbnails/{id}/{filenames[key]}'
+            for i, (name, size) in enumerate(THUMBNAIL_DERIVATIVES[key]):
+                resized_filename = filenames[key].replace('original', name)
+                if i == 0:
+                    data['{}CompressedThumbnail'.format(key)] = f'/thumbnails/{id}/{resized_filename}'
+                jobs.append(executor.submit(save_derivative, images[key], size,
+                                            os.path.join(thumbnails_dir, resized_filename), formats))
+        for job in jobs:
+            job.result()
+    return data
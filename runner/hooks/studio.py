@@ -1,15 +1,17 @@
 import json
 import os
 from pathlib import Path
+import shutil
 import time
 
 from ..utils.file import media_file
-from ..client.file import update_asset, add_asset
-from ..utils import ipfs
+from ..client.file import update_asset, add_asset, merge_updates, batch_updates
+from ..utils import ipfs, index
+from ..utils.manifest import EncodeManifest
 from ..config import ROOT_DIRECTORY, MAX_CPU_LIMIT_PERCENTAGE, MAX_RAM_LIMIT_PERCENTAGE
 from ..helpers import ff_mpeg
 from ..lib.ffmpeg import FFMPEG
-from ..utils.file import gen_random_id, file_type as fileType, get_cpu_usage, get_ram_usage
+from ..utils.file import gen_random_id, file_type as fileType, get_cpu_usage, get_ram_usage, media_root, link_tree
 from ..helpers.file import generate_multiple_thumbnails
 
 def upload_complete_hook(file_path, user_id, root_path=None):
@@ -20,6 +22,7 @@ def upload_complete_hook(file_path, user_id, root_path=None):
     else:
         path = ROOT_DIRECTORY
     if info is not None:
+        index.update_media(path, file_path, info)
         try:
             file_data = {
                 'name': info['name'],
@@ -63,13 +66,26 @@ def upload_complete_hook(file_path, user_id, root_path=None):
         except Exception as e:
             raise e
 
-def asset_file_upload_complete_hook(file_path, asset_id, segment_duration=900, root_path=None):
+def asset_file_upload_complete_hook(file_path, asset_id, segment_duration=900, root_path=None, digest=None):
     info = media_file(file_path)
     print('info: ', info)
     if root_path:
         root_path = os.path.join(root_path, 'media-node-data')
     else:
         root_path = ROOT_DIRECTORY
+    if info is not None:
+        index.update_media(root_path, file_path, info)
+    # updates made to the asset, stored for uploads of the same file
+    result = {}
+
+    def update(data):
+        merge_updates(result, data)
+        return update_asset(asset_id, data)
+
+    def complete_hook(key, segments, path):
+        merge_updates(result, {'encodeStatus': 'COMPLETE', 'encodeSegments': segments, 'encodePath': path})
+        ff_mpeg.complete_hook(key, segments, path)
+
     if info is not None:
         try:
             file_data = {
@@ -83,7 +99,7 @@ def asset_file_upload_complete_hook(file_path, asset_id, segment_duration=900, r
                 'file': file_data,
                 'encodeStatus': 'PROCESSING',
             }
-            update_asset(asset_id, file_data)
+            update(file_data)
 
             destination = os.path.join(root_path, 'assets', asset_id)
             type = fileType(file_path)
@@ -94,56 +110,73 @@ def asset_file_upload_complete_hook(file_path, asset_id, segment_duration=900, r
                 }, file_path, destination, {
                     'error': ff_mpeg.error_hook,
                     'in_progress': ff_mpeg.in_progress_hook,
-                    'complete': ff_mpeg.complete_hook,
+                    'progress': ff_mpeg.progress_hook,
+                    'complete': complete_hook,
                 }, chapter_duration=segment_duration)
             try:
                 if get_cpu_usage() > MAX_CPU_LIMIT_PERCENTAGE or get_ram_usage() > MAX_RAM_LIMIT_PERCENTAGE:
                     print("[FFmpeg] - Warning - CPU/RAM usage is more than threshold limit. waiting (30sec)..")
                     time.sleep(30)
-                    asset_file_upload_complete_hook(file_path, asset_id, segment_duration, root_path)
+                    asset_file_upload_complete_hook(file_path, asset_id, segment_duration, root_path, digest)
                 elif video:
                     encoded_file_path = video.encode()
             except Exception as e:
                 print('[FFmpeg] - unable to encode video')
                 print('Error: ', str(e))
+                # the job is retried, resuming the encode from its checkpoints
+                raise
 
-            # Adding file to ipfs
+            # stages done by an earlier attempt of this job are reused
+            manifest = EncodeManifest(destination, file_path)
+            # the results are sent to the backend as one update
+            with batch_updates():
+                # Adding file to ipfs
 
-            ipfs_hash = ipfs.add_file(file_path)
-            if ipfs_hash is not None:
-                update_asset(asset_id, {'file': {'IPFSHash': ipfs_hash, 'previewIPFSHash': ipfs_hash, 'status': 'COMPLETE'}})
-            else:
-                update_asset(asset_id, {'file': {'status': 'IPFS_PIN_FAILED'}})
+                ipfs_hash = manifest.get('ipfs') or ipfs.add_file(file_path)
+                if ipfs_hash is not None:
+                    manifest.complete('ipfs', ipfs_hash)
+                    update({'file': {'IPFSHash': ipfs_hash, 'previewIPFSHash': ipfs_hash, 'status': 'COMPLETE'}})
+                else:
+                    update_asset(asset_id, {'file': {'status': 'IPFS_PIN_FAILED'}})
 
-            # Adding encoded file to ipfs
+                # Adding encoded file to ipfs
 
-            encoded_file_ipfs_hash = ipfs.add_file(encoded_file_path)
-            if encoded_file_ipfs_hash is not None:
-                update_asset(asset_id, {'file': {'encodedFileIPFSHash': encoded_file_ipfs_hash}})
+                encoded_file_ipfs_hash = manifest.get('ipfs_encoded') or ipfs.add_file(encoded_file_path)
+                if encoded_file_ipfs_hash is not None:
+                    manifest.complete('ipfs_encoded', encoded_file_ipfs_hash)
+                    update({'file': {'encodedFileIPFSHash': encoded_file_ipfs_hash}})
 
-            file_type = file_data['MIMEType'].lower().split('/')[0]
-            if file_type in ['video', 'image']:
-                thumb_dir = os.path.join(root_path, 'thumbnails')
-                thumb_dir = os.path.join(thumb_dir, asset_id)
-                if not os.path.exists(thumb_dir):
-                    os.makedirs(thumb_dir)
-                thumbnails = ff_mpeg.generate_thumbnails(asset_id, file_path, thumb_dir)
-                if file_type == 'image' and thumbnails is None:
-                    thumbnails = {
-                        'horizontal': file_path,
-                    }
-                if thumbnails is not None and len(thumbnails) > 0:
-                    data = {}
-                    preview_hash = ipfs.add_file(thumbnails['horizontal'])
-                    if preview_hash is not None:
-                        data['file'] = {'previewIPFSHash': preview_hash}
-                    thumbnails_data = generate_multiple_thumbnails(asset_id, thumbnails, root_path=root_path)
-                    data['file']['thumbnail'] = thumbnails_data
-                    update_asset(asset_id, data)
+                file_type = file_data['MIMEType'].lower().split('/')[0]
+                if manifest.done('thumbnails'):
+                    update(manifest.get('thumbnails'))
+                elif file_type in ['video', 'image']:
+                    thumb_dir = os.path.join(root_path, 'thumbnails')
+                    thumb_dir = os.path.join(thumb_dir, asset_id)
+                    if not os.path.exists(thumb_dir):
+                        os.makedirs(thumb_dir)
+                    thumbnails = ff_mpeg.generate_thumbnails(asset_id, file_path, thumb_dir,
+                                                             os.path.join(destination, 'scenes.json'))
+                    if file_type == 'image' and thumbnails is None:
+                        thumbnails = {
+                            'horizontal': file_path,
+                        }
+                    if thumbnails is not None and len(thumbnails) > 0:
+                        data = {}
+                        preview_hash = ipfs.add_file(thumbnails['horizontal'])
+                        if preview_hash is not None:
+                            data['file'] = {'previewIPFSHash': preview_hash}
+                        thumbnails_data = generate_multiple_thumbnails(asset_id, thumbnails, root_path=root_path)
+                        data['file']['thumbnail'] = thumbnails_data
+                        manifest.complete('thumbnails', data)
+                        update(data)
+
+            if digest:
+                index.save_result(root_path, digest, result)
 
         except Exception as e:
             print(e)
             update_asset(asset_id, {'file': {'status': 'ERROR'}})
+            raise
     else:
         file_data = {
             'status': 'ERROR',
@@ -153,6 +186,30 @@ def asset_file_upload_complete_hook(file_path, asset_id, segment_duration=900, r
         })
 
 
+def duplicate_file_hook(file_path, asset_id, original_id, result, root_path=None, digest=None):
+    """Applies the results of processing an identical file instead of processing it again.
+
+    The encode and thumbnails of the original asset are hard linked into the
+    asset's own folders and their paths rewritten, so they outlive the original
+    and its re-encodes. When they are gone the file is processed again.
+    """
+    media_path = media_root(root_path)
+    result = json.dumps(result)
+    for folder in ('assets', 'thumbnails'):
+        reference = '/{}/{}/'.format(folder, original_id)
+        if reference not in result:
+            continue
+        source = os.path.join(media_path, folder, original_id)
+        if not os.path.isdir(source):
+            print('outputs of', original_id, 'are gone, processing', file_path)
+            return asset_file_upload_complete_hook(file_path, asset_id, 900, root_path, digest)
+        # the checkpoints of the original are not the asset's
+        link_tree(source, os.path.join(media_path, folder, asset_id),
+                  ignore=shutil.ignore_patterns('encode_manifest.json', 'progress.json'))
+        result = result.replace(reference, '/{}/{}/'.format(folder, asset_id))
+    update_asset(asset_id, json.loads(result))
+
+
 def add_file_to_ipfs(asset_id, file_path):
     data = {}
     file_hash = ipfs.add_file(file_path)
@@ -179,6 +236,7 @@ def file_encode_hook(file_path, asset_id, root_path):
         }, file_path, destination, {
             'error': ff_mpeg.error_hook,
             'in_progress': ff_mpeg.in_progress_hook,
+            'progress': ff_mpeg.progress_hook,
             'complete': ff_mpeg.complete_hook,
         })
     try:
@@ -194,6 +252,7 @@ def file_encode_hook(file_path, asset_id, root_path):
     except Exception as e:
         print('[FFmpeg] - unable to encode video')
         print('Error: ', str(e))
+        raise
 
 
 def default_file_encode_hook(file_path, root_path):
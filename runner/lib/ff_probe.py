@@ -1,43 +1,123 @@
 # coding: utf-8
 import json
+import os
 import shlex
 import subprocess
+from functools import lru_cache
+from typing import NamedTuple, Optional
 
 
-def info(path):
+class MediaInfo(NamedTuple):
+    format: str
+    duration: float
+    size: int
+    bitrate: int
+    streams: list
+    video_codec: Optional[str]
+    audio_codec: Optional[str]
+    width: Optional[int]
+    height: Optional[int]
+    fps: float
+    rotation: int
+
+
+def parse_rate(rate):
+    # frame rates are given as fractions, '30000/1001'
+    try:
+        num, _, den = (rate or '').partition('/')
+        return float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        return 0.0
+
+
+def get_rotation(stream):
+    rotation = stream.get('tags', {}).get('rotate')
+    for side_data in stream.get('side_data_list', []):
+        if 'rotation' in side_data:
+            rotation = side_data['rotation']
+    try:
+        return int(float(rotation or 0)) % 360
+    except ValueError:
+        return 0
+
+
+@lru_cache(maxsize=256)
+def _probe(path, inode, size, mtime_ns):
+    # raises when ffprobe fails, lru_cache doesn't keep exceptions so failures are retried
     args = 'ffprobe -v quiet \
                 -print_format json \
-                -show_entries format=duration,size'
+                -show_format -show_streams'
     args = shlex.split(args)
     args.append(path)
+    output = json.loads(subprocess.check_output(args).decode('utf-8'))
+
+    _format = output.get('format', {})
+    streams = output.get('streams', [])
+    video = next((s for s in streams if s.get('codec_type') == 'video' and 'width' in s), None)
+    audio = next((s for s in streams if s.get('codec_type') == 'audio'), None)
+    return MediaInfo(
+        format=_format.get('format_name', ''),
+        duration=float(_format.get('duration') or 0),
+        size=int(_format.get('size') or size),
+        bitrate=int(_format.get('bit_rate') or 0),
+        streams=streams,
+        video_codec=video['codec_name'] if video else None,
+        audio_codec=audio['codec_name'] if audio else None,
+        width=int(video['width']) if video else None,
+        height=int(video['height']) if video else None,
+        fps=parse_rate(video.get('avg_frame_rate') or video.get('r_frame_rate')) if video else 0.0,
+        rotation=get_rotation(video) if video else 0,
+    )
+
+
+def probe(path):
+    """Returns the `MediaInfo` of a media file from a single ffprobe run, or None.
+
+    Results are memoized per path, inode, size and mtime, so a file is only
+    probed again once it has changed. Failures aren't memoized.
+    """
     try:
-        output = subprocess.check_output(args).decode('utf-8')
-        output = json.loads(output)
+        stat = os.stat(path)
+    except (OSError, TypeError):
+        return None
+    try:
+        return _probe(os.path.abspath(path), stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    except (subprocess.CalledProcessError, OSError, ValueError) as e:
+        print('ffprobe failed for', path, e)
+        return None
 
-        return int(output['format']['size']), float(output['format']['duration'])
-    except subprocess.CalledProcessError:
-        return 0, 0
-    except Exception as e:
+
+def info(path):
+    media = probe(path)
+    if media is None or not media.duration:
         return 0, 0
+    return media.size, media.duration
 
 
 def get_resolution(path):
-    args = 'ffprobe -v quiet \
-                -print_format json \
-                -show_entries stream=width,height'
-    args = shlex.split(args)
-    args.append(path)
-    try:
-        output = subprocess.check_output(args).decode('utf-8')
-        output = json.loads(output)
-        if len(output['streams']):
-            for stream in output['streams']:
-                if 'width' in stream:
-                    return int(stream['width']), int(stream['height'])
+    media = probe(path)
+    if media is None or media.width is None:
         return None, None
+    return media.width, media.height
 
-    except subprocess.CalledProcessError:
-        return None, None
 
-    except Exception as e:
-        return None, None
\ No newline at end of file
+def keyframe_times(path, seconds=30):
+    """Returns the pts times of the video keyframes in the first `seconds` of a file.
+
+    Only packet headers are read, nothing is decoded.
+    """
+    args = ['ffprobe', '-v', 'error',
+            '-select_streams', 'v:0',
+            '-read_intervals', '%+{}'.format(seconds),
+            '-show_entries', 'packet=pts_time,flags',
+            '-of', 'csv=p=0', path]
+    try:
+        output = subprocess.check_output(args).decode('utf-8')
+    except (subprocess.CalledProcessError, OSError):
+        return []
+    times = []
+    for line in output.splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags and pts_time not in ('', 'N/A'):
+            times.append(float(pts_time))
+    return sorted(times)
@@ -1,20 +1,135 @@
 # coding: utf-8
 import json
+import math
 import os
 import re
-import random
 import shutil
 import subprocess
 import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from .ff_probe import info, get_resolution
+from redis import Redis
+from rq import Queue, Worker, get_current_job
+from rq.timeouts import JobTimeoutException
+
+from .ff_probe import info, get_resolution, probe, keyframe_times
+from .progress import EncodeProgress
+from .thumbnail import extract_thumbnails, select_thumbnail_time, thumbnail_sizes, sprite_size, sprite_filter, \
+    sprite_output_args, write_sprite_track
 from ..utils.file import is_valid_encode
+from ..utils.manifest import EncodeManifest
+from ..config import ENCODE_MODE, ENCODE_THREADS, ENCODE_LADDER, ENCODE_AUDIO_ONLY, ENCODE_CHUNK_DURATION, \
+    ENCODE_CHUNK_JOBS, ENCODE_CHUNK_QUEUE, ENCODE_PASSTHROUGH, ENCODE_PASSTHROUGH_MAX_GOP, ENCODE_DURATION_TOLERANCE, SCENE_DETECT_MODE, SCENE_DETECT_FPS, SCENE_DETECT_WIDTH, REDIS_HOST, \
+    REDIS_PORT, SPRITE_INTERVAL
+
+
+# how long a chunk may take on the ENCODE_CHUNK_QUEUE workers
+CHUNK_TIMEOUT = ENCODE_CHUNK_DURATION * 10
+
+
+def encode_job_timeout(file_path, timeout):
+    """Timeout of a job encoding `file_path`, in chunked mode raised by the time its chunks may take."""
+    if ENCODE_MODE != 'chunked':
+        return timeout
+    media = probe(file_path)
+    if media is None:
+        return timeout
+    return timeout + math.ceil(media.duration / ENCODE_CHUNK_DURATION) * CHUNK_TIMEOUT
+
+
+def escape_filter_path(path):
+    # escaped for the filter option value, then for the filtergraph
+    path = path.replace('\\', '\\\\').replace(':', '\\:').replace("'", "\\'")
+    for char in "\\'[],;":
+        path = path.replace(char, '\\' + char)
+    return path
+
+
+def wait_process(process, cmd, read=None):
+    """Waits for an ffmpeg process, after passing its output to `read`.
+
+    The process is killed when waiting is interrupted, by a job timeout among
+    others, instead of being left running on the files of the retried job.
+    """
+    try:
+        if read is not None:
+            read(process.stdout)
+        process.wait()
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    finally:
+        if process.stdout is not None:
+            process.stdout.close()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+
+
+def run_encode_cmd(cmd, on_progress=None, processes=None):
+    """Runs an ffmpeg command, also queued for chunks encoded by other workers.
+
+    With `on_progress` the `-progress` output of ffmpeg is read from a pipe and
+    each of its blocks is passed to it as a dict. The process is kept in the
+    `processes` set while it runs.
+    """
+    print(' '.join(cmd))
+
+    def read(stdout):
+        block = {}
+        for line in stdout:
+            key, _, value = line.strip().partition('=')
+            block[key] = value
+            # every block ends with its progress=continue|end line
+            if key == 'progress':
+                on_progress(block)
+                block = {}
+
+    if on_progress is None:
+        process = subprocess.Popen(cmd)
+    else:
+        cmd = cmd[:1] + ['-progress', 'pipe:1', '-nostats'] + cmd[1:]
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+    if processes is not None:
+        processes.add(process)
+    try:
+        wait_process(process, cmd, read if on_progress is not None else None)
+    finally:
+        if processes is not None:
+            processes.discard(process)
+
+
+# profiles of h264 streams that are copied into renditions as they are
+PASSTHROUGH_PROFILES = ('Constrained Baseline', 'Baseline', 'Main', 'High')
+
+
+def media_duration(media):
+    return media.duration if media is not None else 0
+
+
+def media_stream(media, codec_type):
+    return next((stream for stream in media.streams if stream.get('codec_type') == codec_type), {})
+
+
+def stream_duration(media, codec_type):
+    # containers such as webm only have a duration for the whole file
+    stream = media_stream(media, codec_type)
+    try:
+        return float(stream.get('duration') or 0) or (media.duration if stream else 0)
+    except ValueError:
+        return media.duration if stream else 0
+
+
+def copies_video(rung):
+    return 'video' in (rung.get('copy') or [])
 
 
 class FFMPEG:
     def __init__(self, key, file_path, destination_path, hooks, chapter_duration=300, scene_cut_threshold=0.5,
                  video_codec='libx264', video_bitrate=4000, audio_codec='aac', audio_bitrate=320, frames_per_sec=25,
-                 resolution='1920x1080', preset='superfast', ext='.mp4'):
+                 resolution='1920x1080', preset='superfast', ext='.mp4', encode_mode=None, threads=None,
+                 ladder=None, audio_only=None, scene_detect_mode=None):
         self.key = key
         self.file_path = file_path
         self.destination_path = destination_path
@@ -31,17 +146,101 @@ class FFMPEG:
         self.preset = preset
         self.hooks = hooks
         self.ext = ext
+        self.encode_mode = encode_mode or ENCODE_MODE
+        self.threads = threads or ENCODE_THREADS
+        self.ladder = ladder or ENCODE_LADDER
+        self.audio_only = ENCODE_AUDIO_ONLY if audio_only is None else audio_only
+        self.scene_detect_mode = scene_detect_mode or SCENE_DETECT_MODE
         self.video_nft_folder = os.path.join(self.destination_path)
         self.segments_folder = os.path.join(self.video_nft_folder, 'segments')
         self.m3u8_file = '{0}/master.m3u8'.format(self.segments_folder)
+        self.sprites_folder = os.path.join(self.segments_folder, 'thumbnails')
+        self.sprites_file = os.path.join(self.segments_folder, 'thumbnails.vtt')
         self.mp4_file = '{0}/default.mp4'.format(self.destination_path)
+        self.progress_file = os.path.join(self.video_nft_folder, 'progress.json')
+        self.progress = None
+        self.keyframes_sane = None
+        # ffmpeg processes of the encode still running, from every thread
+        self.processes = set()
 
-    def _get_scene_cuts(self):
+    def _run(self, cmd, task=None):
+        """Runs an ffmpeg command, reporting its progress as `task` of the encode progress."""
+        on_progress = None
+        if task is not None and self.progress is not None:
+            on_progress = self.progress.callback(task)
+        run_encode_cmd(cmd, on_progress, self.processes)
+
+    def _kill(self):
+        """Kills the ffmpeg processes of other threads, so they fail instead of being waited for."""
+        for process in list(self.processes):
+            process.kill()
+
+    def _track(self, task, rungs, duration):
+        if self.progress is not None:
+            self.progress.add(task, [rung['name'] for rung in rungs], duration)
+
+    def _parse_scene_metadata(self, lines):
+        """Yields the frames of `metadata=print` output scoring at least the scene cut threshold."""
+        frame_info = {}
+        for line in lines:
+            line = line.strip()
+
+            if line.startswith('frame'):
+                frame_regex = r'frame:(?P<frame>\d+)\s+pts:(?P<pts>[\d\.]+)\s+pts_time:(?P<pts_time>[\d\.]+)'
+                match = re.match(frame_regex, line)
+                if match:
+                    matches = match.groupdict()
+                    frame_info = {
+                        'frame': int(matches['frame']),
+                        'pts': float(matches['pts']),
+                        'pts_time': float(matches['pts_time']),
+                    }
+                else:
+                    raise RuntimeError('wrongly formatted line: ' + line)
+
+            elif line.startswith('lavfi.scene_score'):
+                score = float(line.split('=')[1])
+                frame_info['score'] = score
+                if score >= self.scene_cut_threshold:
+                    yield frame_info
+                frame_info = {}
+
+    def _scene_filter(self, output):
+        return 'fps={0},scale={1}:-2,select=gte(scene\\,{2}),metadata=print:file={3}'.format(
+            SCENE_DETECT_FPS, SCENE_DETECT_WIDTH, self.scene_cut_threshold, escape_filter_path(output))
+
+    @staticmethod
+    def _scene_output_args(vf, sprites=None):
+        if sprites is None:
+            return ['-vf', vf, '-an', '-f', 'null', '-']
+        # the sprite sheets are tiled from the same decode
+        graph = '[0:v]split[sc][sp];[sc]{0}[scenes];[sp]{1}[sprites]'.format(vf, sprites['filter'])
+        return ['-filter_complex', graph, '-map', '[scenes]', '-f', 'null', '-',
+                '-map', '[sprites]'] + sprites['output']
+
+    def _get_fast_scene_cuts(self, sprites=None):
+        """Scores scene changes on a small, decimated stream, streaming only the cuts over a pipe."""
+        cmd = [
+            'ffmpeg',
+            '-hide_banner', '-loglevel', 'error',
+            '-skip_loop_filter', 'all', '-flags2', '+fast',
+            '-i', self.file_path,
+        ] + self._scene_output_args(self._scene_filter('pipe:1'), sprites)
+        scene_cuts = []
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+        wait_process(process, cmd, lambda stdout: scene_cuts.extend(self._parse_scene_metadata(stdout)))
+        return scene_cuts
+
+    def _get_scene_cuts(self, sprites=None):
+        """Scores the scene changes of the source, also writing its sprite sheets with `sprites`."""
         temp_file_name, scene_cuts = '', []
         try:
             if not (0 <= self.scene_cut_threshold <= 1):
                 raise RuntimeError('scene_cut threshold must be between 0 and 1')
 
+            if self.scene_detect_mode == 'fast':
+                return self._get_fast_scene_cuts(sprites)
+
             temp_dir = tempfile.gettempdir()
             temp_file_name = os.path.join(
                 temp_dir, next(tempfile._get_candidate_names()) + '.txt'
@@ -51,40 +250,18 @@ class FFMPEG:
                 'ffmpeg',
                 '-hide_banner', '-loglevel', 'error',
                 '-y', '-i', self.file_path,
-                '-vf', 'select=gte(scene\,0),metadata=print:file=' + temp_file_name,
-                '-an', '-f', 'null', '-']
-            subprocess.check_call(cmd)
+            ] + self._scene_output_args('select=gte(scene\\,0),metadata=print:file=' + temp_file_name, sprites)
+            self._run(cmd)
 
             lines = []
             if os.path.isfile(temp_file_name):
                 with open(temp_file_name, 'r') as out:
                     lines = out.readlines()
 
-            frame_info = {}
-            for line in lines:
-                line = line.strip()
-
-                if line.startswith('frame'):
-                    frame_regex = r'frame:(?P<frame>\d+)\s+pts:(?P<pts>[\d\.]+)\s+pts_time:(?P<pts_time>[\d\.]+)'
-                    match = re.match(frame_regex, line)
-                    if match:
-                        matches = match.groupdict()
-                        frame_info['frame'] = int(matches['frame'])
-                        frame_info['pts'] = float(matches['pts'])
-                        frame_info['pts_time'] = float(matches['pts_time'])
-                    else:
-                        raise RuntimeError('wrongly formatted line: ' + line)
-
-                elif line.startswith('lavfi.scene_score'):
-
-                    score = line.split('=')[1]
-                    frame_info['score'] = float(score)
-                    if float(score) >= self.scene_cut_threshold:
-                        scene_cuts.append(frame_info)
-                        frame_info = {}
-            if not len(scene_cuts):
-                scene_cuts.append(frame_info)
+            scene_cuts = list(self._parse_scene_metadata(lines))
 
+        except JobTimeoutException:
+            raise
         except Exception as e:
             print(e)
         finally:
@@ -93,6 +270,35 @@ class FFMPEG:
 
         return scene_cuts
 
+    def _read_scene_scores(self, scene_scores_file):
+        scene_cuts = []
+        if os.path.isfile(scene_scores_file):
+            with open(scene_scores_file, 'r') as f:
+                scene_cuts = list(self._parse_scene_metadata(f))
+            os.remove(scene_scores_file)
+        return scene_cuts
+
+    def _save_scenes(self, scenes, duration):
+        """Writes `scenes.json` and `chapters.json`, returns the chapter segments."""
+        scenes_file = os.path.join(self.video_nft_folder, 'scenes.json')
+        self._save_scenecuts(scenes, scenes_file, duration)
+        chapters = self._generate_chapters(scenes)
+
+        if len(chapters) == 0 or (len(chapters) and duration - chapters[-1] >= 3):
+            chapters.append(duration)
+
+        chapters_file = os.path.join(self.video_nft_folder, 'chapters.json')
+        with open(chapters_file, 'w', encoding='utf-8') as file:
+            json.dump(chapters, file, ensure_ascii=False, indent=4)
+        return self._get_segments(chapters)
+
+    def _scenes_stage(self, scenes, duration):
+        # the cut times are kept for splitting chunks when the encode is resumed
+        return {
+            'cuts': [scene['pts_time'] for scene in scenes if 'pts_time' in scene],
+            'segments': self._save_scenes(scenes, duration),
+        }
+
     def _generate_chapters(self, scenes):
         chapters, last_scene_time = [], 0
         for scene in scenes:
@@ -173,7 +379,10 @@ class FFMPEG:
             '-hls_segment_filename', self.segments_folder + '/' + 'seg_%05d.ts',
             str(self.m3u8_file)
         ]
-        subprocess.call(cmd)
+        try:
+            self._run(cmd)
+        except subprocess.CalledProcessError as e:
+            print(e)
         print('generated m3u8 playlist for ', self.file_path, 'at ', self.m3u8_file)
 
     def generate_scenes_file(self, duration):
@@ -186,45 +395,14 @@ class FFMPEG:
             thumbnails_folder = os.path.join(self.video_nft_folder, 'thumbnails')
             if not os.path.exists(thumbnails_folder):
                 os.makedirs(thumbnails_folder)
-            thumbnail_file_h = os.path.join(thumbnails_folder, self.key['_id'] + '_horizontal.jpg')
             _, duration = info(self.file_path)
-            cmd_h = ['ffmpeg', '-y',
-                     '-hide_banner', '-v', 'error',
-                     '-i', self.file_path,
-                     '-ss', str(random.choice(range(int(duration) % 100))),
-                     '-vframes', '1',
-                     '-s', f'{self.width}x{self.height}',
-                     thumbnail_file_h,
-                     ]
-            print(' '.join(cmd_h))
-            subprocess.check_call(cmd_h)
-            thumbnail_file_v = os.path.join(thumbnails_folder, self.key['_id'] + '_vertical.jpg')
-            cmd_v = ['ffmpeg', '-y',
-                     '-hide_banner', '-v', 'error',
-                     '-i', self.file_path,
-                     '-ss', str(random.choice(range(int(duration) % 100))),
-                     '-vframes', '1',
-                     '-s', f'{self.height}x{self.width}',
-                     thumbnail_file_v,
-                     ]
-            subprocess.check_call(cmd_v)
-            thumbnail_file_s = os.path.join(thumbnails_folder, self.key['_id'] + '_square.jpg')
-            cmd_s = ['ffmpeg', '-y',
-                     '-hide_banner', '-v', 'error',
-                     '-i', self.file_path,
-                     '-ss', str(random.choice(range(int(duration) % 100))),
-                     '-vframes', '1',
-                     '-s', f'{self.height}x{self.height}',
-                     thumbnail_file_s,
-                     ]
-            subprocess.check_call(cmd_s)
-            thumbnails = {
-                'horizontal': thumbnail_file_h,
-                'vertical': thumbnail_file_v,
-                'square': thumbnail_file_s,
-            }
+            seek = select_thumbnail_time(self.file_path, duration, os.path.join(self.video_nft_folder, 'scenes.json'))
+            thumbnails = extract_thumbnails(self.file_path, thumbnails_folder, self.key['_id'],
+                                            thumbnail_sizes(self.width, self.height), seek)
             print('generated thumbnail : ', thumbnails)
             return thumbnails
+        except JobTimeoutException:
+            raise
         except Exception as e:
             print(e)
             return None
@@ -241,24 +419,659 @@ class FFMPEG:
             start = chapters[i]
         return segments
 
+    def _sane_keyframes(self):
+        """Whether the source has keyframes often enough to be cut into HLS segments as it is."""
+        if self.keyframes_sane is None:
+            times = keyframe_times(self.file_path)
+            gaps = [end - start for start, end in zip(times[:-1], times[1:])]
+            self.keyframes_sane = len(times) > 1 and times[0] <= 0.1 and max(gaps) <= ENCODE_PASSTHROUGH_MAX_GOP
+        return self.keyframes_sane
+
+    def _passthrough(self, media, width, height, bitrate, segmented=True, codec=None, profile=None):
+        """Returns the streams of the source that can be copied into an output of the given size and bitrate.
+
+        The video is copied when it is h264 4:2:0 at that size and not above the
+        bitrate, the output's `codec` is an h264 encoder and its `profile`, when
+        set, is the source's and, for `segmented` outputs, the source has sane
+        keyframe intervals. The audio is copied along with it when it is aac.
+        """
+        if not ENCODE_PASSTHROUGH or media is None or media.video_codec != 'h264' or media.rotation:
+            return []
+        codec = codec or self.video_codec
+        if codec != 'libx264' and not codec.startswith('h264'):
+            return []
+        video = media_stream(media, 'video')
+        video_bitrate = int(video.get('bit_rate') or media.bitrate or 0)
+        # up to 1.5 times the rung's bitrate, encoders producing compliant files vary around it
+        if (media.width, media.height) != (width, height) or video.get('pix_fmt') != 'yuv420p' \
+                or video.get('profile') not in PASSTHROUGH_PROFILES or not 0 < video_bitrate <= bitrate * 1500:
+            return []
+        # 'baseline' is met by constrained baseline sources as well
+        if profile and video['profile'].lower().replace('constrained ', '') != profile.lower():
+            return []
+        if segmented and not self._sane_keyframes():
+            return []
+        audio = media_stream(media, 'audio')
+        if media.audio_codec == 'aac' and int(audio.get('channels') or 0) <= 2:
+            return ['video', 'audio']
+        return ['video']
+
+    def _audio_map(self, media):
+        # the silent input only stands in for a missing audio stream
+        return '1:a:0' if media is not None and media.audio_codec else '0:a'
+
+    def renditions(self, media):
+        """Picks the ladder rungs to encode for the probed source `media`.
+
+        Rungs are turned to the orientation of the source, as displayed, and those
+        wider or taller than it are skipped; when every rung is, the lowest one is
+        kept at the source resolution with its bitrate scaled down accordingly.
+        Rungs the source already matches get the streams to `copy` instead of
+        encoding them, chunks are always encoded as their bounds needn't be keyframes.
+        """
+        ladder = sorted(self.ladder, key=lambda rung: rung['height'])
+        rungs = ladder
+        if media is not None and media.height:
+            width, height = media.width, media.height
+            if media.rotation in (90, 270):
+                width, height = height, width
+            if width < height:
+                # portrait sources get the rungs turned, named after their short side all the same
+                ladder = [dict(rung, width=rung['height'], height=rung['width']) for rung in ladder]
+            rungs = [rung for rung in ladder if rung['width'] <= width and rung['height'] <= height]
+            if not rungs:
+                rung = ladder[0]
+                # even dimensions, as required by yuv420p
+                width, height = width - width % 2, height - height % 2
+                rungs = [dict(rung, name='{}p'.format(min(width, height)), width=width, height=height,
+                              bitrate=max(1, rung['bitrate'] * width * height // (rung['width'] * rung['height'])))]
+        if self.encode_mode != 'chunked':
+            for i, rung in enumerate(rungs):
+                copy = self._passthrough(media, rung['width'], rung['height'], rung['bitrate'],
+                                         codec=rung.get('codec'), profile=rung.get('profile'))
+                if copy:
+                    rungs[i] = dict(rung, copy=copy)
+        if self.audio_only and (media is None or media.audio_codec):
+            rung = {'name': 'audio', 'audio_only': True, 'bitrate': int(self.audio_bitrate)}
+            if ENCODE_PASSTHROUGH and media is not None and media.audio_codec == 'aac':
+                rung['copy'] = ['audio']
+            rungs = rungs + [rung]
+        return rungs
+
+    def _codec_args(self, rung, threads=None):
+        """Encoder options of a rendition, streams the source already matches are copied."""
+        copy = rung.get('copy') or []
+        args = []
+        if 'video' in copy:
+            args += ['-c:v', 'copy']
+        elif not rung.get('audio_only'):
+            args += [
+                '-vcodec', rung.get('codec') or self.video_codec,
+                '-r', str(self.frames_per_sec),
+                '-g', str(self.frames_per_sec * 2),
+                '-crf', '22',
+                '-preset', self.preset,
+                '-keyint_min', str(self.frames_per_sec * 2),
+                '-maxrate', str(rung['bitrate']) + 'k',
+                '-b:v', str(rung['bitrate']) + 'k',
+            ]
+            if rung.get('profile'):
+                # the h264 profiles players support need 4:2:0 chroma
+                args += ['-profile:v', rung['profile'], '-pix_fmt', 'yuv420p']
+            args += [
+                '-tune', 'fastdecode',
+                '-tune', 'zerolatency',
+            ]
+        if 'audio' in copy:
+            args += ['-c:a', 'copy']
+        else:
+            args += [
+                '-acodec', self.audio_codec,
+                '-ar', '44100',
+                '-ac', '2',
+                '-b:a', str(self.audio_bitrate) + 'k',
+            ]
+        args += [
+            '-max_muxing_queue_size', '1024',
+            '-max_interleave_delta', '0',
+            '-reset_timestamps', '1',
+            '-async', '1',
+        ]
+        if threads:
+            args += ['-threads', str(threads)]
+        return args
+
+    def _shortest(self, rung, media):
+        # only needed to end the silent input, copied video would be cut short at a keyframe
+        return not copies_video(rung) or self._audio_map(media) == '0:a'
+
+    def _rendition_output_args(self, rung, threads=None, chunk=None, offset=0, shortest=True):
+        """Output options of an HLS rendition, the streams to encode are mapped by the caller.
+
+        A `chunk` (index, start, end) of the source is written to its own playlist
+        and segments, to be stitched with the others by `_stitch_chunks`. With an
+        `offset` the segments are appended to those of an interrupted encode.
+        """
+        resolution_folder = os.path.join(self.segments_folder, rung['name'])
+        os.makedirs(resolution_folder, exist_ok=True)
+        if chunk is None:
+            segment_filename = f"{resolution_folder}/seg_%05d.ts"
+            output_m3u8 = f"{resolution_folder}/master.m3u8"
+        else:
+            segment_filename = f"{resolution_folder}/chunk{chunk[0]:04d}_%05d.ts"
+            output_m3u8 = f"{resolution_folder}/chunk{chunk[0]:04d}.m3u8"
+        args = self._codec_args(rung, threads)
+        if shortest:
+            args += ['-shortest']
+        args += [
+            '-f', 'hls',
+            '-hls_time', '4',
+            '-hls_playlist_type', 'vod',
+            '-hls_list_size', '0',
+            '-hls_segment_filename', segment_filename,
+        ]
+        if chunk is not None:
+            # keeps the timestamps of the stitched renditions increasing
+            args += ['-output_ts_offset', str(chunk[1])]
+        elif offset:
+            # the muxer carries on the segment numbering of the existing playlist
+            args += ['-hls_flags', 'append_list', '-output_ts_offset', str(offset)]
+        return args + ['-y', output_m3u8]
+
+    def _source_args(self, rung, media, offset=0):
+        """Inputs of a single rendition encode, read from `offset` seconds of the source."""
+        cmd = [
+            'ffmpeg',
+            '-hide_banner', '-v', 'error',
+            '-f', 'lavfi', '-i', 'aevalsrc=0',
+        ]
+        if offset:
+            cmd += ['-ss', str(offset)]
+        cmd += ['-i', self.file_path]
+        if rung.get('audio_only'):
+            # only added for sources with audio, the silent input never ends
+            cmd += ['-map', '1:a:0']
+        elif copies_video(rung):
+            cmd += ['-map', '1:v:0', '-map', self._audio_map(media)]
+        else:
+            cmd += ['-vf', f"scale={rung['width']}:{rung['height']}"]
+        return cmd
+
+    def _rendition_cmd(self, rung, threads=None, offset=0, media=None):
+        return self._source_args(rung, media, offset) + self._rendition_output_args(
+            rung, threads, offset=offset, shortest=self._shortest(rung, media))
+
+    def _segment_cmd(self, rung, media, start, duration, segment_file):
+        # a single segment, its timestamps continue those of the segments around it
+        cmd = self._source_args(rung, media, start) + ['-t', str(duration)] + self._codec_args(rung)
+        if self._shortest(rung, media):
+            cmd += ['-shortest']
+        return cmd + [
+            '-f', 'mpegts',
+            '-output_ts_offset', str(start),
+            '-y', segment_file,
+        ]
+
+    def _read_playlist(self, rung):
+        """Parses the playlist of a rendition.
+
+        Returns its header lines, its segments as (duration, lines) and whether it
+        is complete.
+        """
+        playlist = os.path.join(self.segments_folder, rung['name'], 'master.m3u8')
+        header, entries, lines, complete = [], [], [], False
+        if os.path.isfile(playlist):
+            with open(playlist) as f:
+                for line in f:
+                    line = line.strip()
+                    if line == '#EXT-X-ENDLIST':
+                        complete = True
+                    elif line.startswith('#EXTINF:') or line == '#EXT-X-DISCONTINUITY':
+                        lines.append(line)
+                    elif line and not line.startswith('#'):
+                        duration = next((float(l[8:].split(',')[0]) for l in lines if l.startswith('#EXTINF:')), 0)
+                        entries.append((duration, lines + [line]))
+                        lines = []
+                    elif line and not entries and not lines:
+                        header.append(line)
+        return header, entries, complete
+
+    def _truncate_rendition(self, rung, offset):
+        """Drops the segments of a partially written rendition ending after `offset` seconds.
+
+        Returns where the kept segments end, the encode resumes from there.
+        """
+        resolution_folder = os.path.join(self.segments_folder, rung['name'])
+        header, entries, _ = self._read_playlist(rung)
+        kept, end = [], 0
+        for duration, lines in entries:
+            if round(end + duration, 2) > round(offset, 2):
+                break
+            end += duration
+            kept.append(lines)
+        if not os.path.isdir(resolution_folder):
+            return 0
+        segments = {lines[-1] for lines in kept}
+        for name in os.listdir(resolution_folder):
+            if name.startswith('seg_') and name.endswith('.ts') and name not in segments:
+                os.remove(os.path.join(resolution_folder, name))
+        playlist = os.path.join(resolution_folder, 'master.m3u8')
+        if kept:
+            with open(playlist, 'w') as f:
+                f.write('\n'.join(header + [line for lines in kept for line in lines]) + '\n')
+        elif os.path.exists(playlist):
+            os.remove(playlist)
+        return end
+
+    def _resume_offset(self, rung):
+        # an interrupted rendition is only written up to its last complete segment. Copied
+        # video can't be seeked to a segment boundary, only to the keyframe before it, and
+        # is remuxed from the start instead, which costs little
+        _, entries, _ = self._read_playlist(rung)
+        if copies_video(rung):
+            return self._truncate_rendition(rung, 0)
+        return self._truncate_rendition(rung, sum(duration for duration, _ in entries))
+
+    def _common_resume_offset(self, rungs):
+        """Truncates the renditions encoded together to the last segment boundary they share."""
+        boundaries = None
+        for rung in rungs:
+            _, entries, _ = self._read_playlist(rung)
+            ends, end = {0}, 0
+            for duration, _ in entries:
+                end += duration
+                ends.add(round(end, 2))
+            boundaries = ends if boundaries is None else boundaries & ends
+        offset = max(boundaries or [0])
+        if any(copies_video(rung) for rung in rungs):
+            # see _resume_offset
+            offset = 0
+        for rung in rungs:
+            self._truncate_rendition(rung, offset)
+        return offset
+
+    def _validate_rendition(self, rung, duration):
+        """Checks the playlist and segments of an encoded rendition.
+
+        Returns the indexes of the segments that are missing or empty and whether
+        the rendition ends short of the source `duration`, or None when there is
+        no usable playlist.
+        """
+        resolution_folder = os.path.join(self.segments_folder, rung['name'])
+        _, entries, complete = self._read_playlist(rung)
+        if not entries:
+            return None
+        broken = []
+        for i, (segment_duration, lines) in enumerate(entries):
+            segment_file = os.path.join(resolution_folder, lines[-1])
+            if segment_duration <= 0 or not os.path.isfile(segment_file) or os.path.getsize(segment_file) == 0:
+                broken.append(i)
+        encoded = sum(segment_duration for segment_duration, _ in entries)
+        return broken, not complete or duration - encoded > ENCODE_DURATION_TOLERANCE
+
+    def _rendition_duration(self, rung, media, duration):
+        """Duration a complete rendition has, rather than the container's `duration`.
+
+        With -shortest the output stops with the shorter of the video and the
+        source audio, without it, it lasts as long as the longer one.
+        """
+        if media is None:
+            return duration
+        audio = stream_duration(media, 'audio')
+        if rung.get('audio_only'):
+            return audio or duration
+        video = stream_duration(media, 'video')
+        if not video:
+            return duration
+        if not audio:
+            return video
+        return min(video, audio) if self._shortest(rung, media) else max(video, audio)
+
+    def _repair_rendition(self, rung, media, manifest, duration):
+        """Re-encodes only the broken segments of a rendition, or its missing end.
+
+        A rendition without a usable playlist, with most of its segments broken or
+        with broken segments of copied video, which can't be cut at their
+        boundaries, is encoded again on its own.
+        """
+        resolution_folder = os.path.join(self.segments_folder, rung['name'])
+        duration = self._rendition_duration(rung, media, duration)
+        validation = self._validate_rendition(rung, duration)
+        _, entries, _ = self._read_playlist(rung)
+        if validation is None or len(validation[0]) > len(entries) / 2 or (validation[0] and copies_video(rung)):
+            print('re-encoding rendition', rung['name'])
+            shutil.rmtree(resolution_folder, ignore_errors=True)
+            self._encode_rendition(rung, media, manifest)
+            return
+        broken, short = validation
+        start = 0
+        for i, (segment_duration, lines) in enumerate(entries):
+            if i in broken and segment_duration > 0:
+                print('re-encoding segment', lines[-1], 'of', rung['name'])
+                self._run(self._segment_cmd(rung, media, start, segment_duration,
+                                            os.path.join(resolution_folder, lines[-1])))
+            start += segment_duration
+        if short:
+            print('encoding the missing end of', rung['name'])
+            self._encode_rendition(rung, media, manifest)
+        if broken or short:
+            validation = self._validate_rendition(rung, duration)
+            if validation is None or validation[0] or validation[1]:
+                print('rendition', rung['name'], 'of', self.file_path, 'is still incomplete')
+
+    def _encode_rendition(self, rung, media, manifest, threads=None):
+        offset = self._resume_offset(rung)
+        if offset:
+            print('resuming', rung['name'], 'from', offset)
+        self._track(rung['name'], [rung], media_duration(media) - offset)
+        cmd = self._rendition_cmd(rung, threads, offset, media)
+        self._run(cmd, rung['name'])
+        manifest.complete('rendition:' + rung['name'])
+        return cmd
+
+    def _encode_serial(self, rungs, media, manifest):
+        for rung in rungs:
+            self._track(rung['name'], [rung], media_duration(media))
+        return [self._encode_rendition(rung, media, manifest) for rung in rungs]
+
+    def _encode_parallel(self, rungs, media, manifest):
+        # the thread budget is split between the concurrent ffmpeg processes
+        threads = max(1, self.threads // len(rungs))
+        with ThreadPoolExecutor(max_workers=len(rungs)) as executor:
+            try:
+                return list(executor.map(lambda rung: self._encode_rendition(rung, media, manifest, threads), rungs))
+            except BaseException:
+                # the executor waits for the other renditions before the error is raised
+                self._kill()
+                raise
+
+    def _single_cmd(self, rungs, media, threads, chunk=None, scene_scores_file=None, offset=0, sprites=None):
+        audio_map = self._audio_map(media)
+        # copied renditions take the source video as it is, the others a split of the decoded one
+        video_rungs = [rung for rung in rungs if not rung.get('audio_only') and not copies_video(rung)]
+        branches = len(video_rungs) + (1 if scene_scores_file else 0) + (1 if sprites else 0)
+        graph = '[1:v]split={0}{1}'.format(branches, ''.join('[s{}]'.format(i) for i in range(branches)))
+        for i, rung in enumerate(video_rungs):
+            graph += ';[s{0}]scale={1}:{2}[v{0}]'.format(i, rung['width'], rung['height'])
+        if scene_scores_file:
+            # scene scoring as a side output of the decode feeding the encoders
+            graph += ';[s{0}]{1},nullsink'.format(len(video_rungs), self._scene_filter(scene_scores_file))
+        if sprites:
+            graph += ';[s{0}]{1}[sprites]'.format(branches - 1, sprites['filter'])
+        cmd = [
+            'ffmpeg',
+            '-hide_banner', '-v', 'error',
+            '-f', 'lavfi', '-i', 'aevalsrc=0',
+        ]
+        if chunk is not None:
+            cmd += ['-ss', str(chunk[1]), '-t', str(chunk[2] - chunk[1])]
+        elif offset:
+            cmd += ['-ss', str(offset)]
+        cmd += ['-i', self.file_path]
+        if branches:
+            cmd += ['-filter_complex', graph]
+        for rung in rungs:
+            if rung.get('audio_only'):
+                cmd += ['-map', audio_map]
+            elif rung not in video_rungs:
+                cmd += ['-map', '1:v:0', '-map', audio_map]
+            else:
+                cmd += ['-map', '[v{}]'.format(video_rungs.index(rung)), '-map', audio_map]
+            cmd += self._rendition_output_args(rung, threads, chunk, offset, self._shortest(rung, media))
+        if sprites:
+            cmd += ['-map', '[sprites]'] + sprites['output']
+        return cmd
+
+    def _encode_single(self, rungs, media, manifest, scene_scores_file=None, sprites=None):
+        """Decodes the source once and encodes every rendition from a split of the decoded video.
+
+        With a `scene_scores_file` the scene cuts are written to it from the same
+        decode, and so are the sprite sheets with `sprites`.
+        """
+        offset = self._common_resume_offset(rungs)
+        if offset:
+            print('resuming', ', '.join(rung['name'] for rung in rungs), 'from', offset)
+        # the encoders of all renditions run at the same time, each gets a share of the threads
+        cmd = self._single_cmd(rungs, media, max(1, self.threads // len(rungs)), scene_scores_file=scene_scores_file,
+                               offset=offset, sprites=sprites)
+        task = '+'.join(rung['name'] for rung in rungs)
+        self._track(task, rungs, media_duration(media) - offset)
+        self._run(cmd, task)
+        for rung in rungs:
+            manifest.complete('rendition:' + rung['name'])
+        return [cmd]
+
+    def _chunks(self, cuts, duration):
+        """Splits the source into (index, start, end) chunks of about `ENCODE_CHUNK_DURATION` seconds.
+
+        Chunks end at the scene cut closest to their target length, when there is
+        one within a quarter of it.
+        """
+        bounds = [0]
+        while duration - bounds[-1] > ENCODE_CHUNK_DURATION * 1.5:
+            target = bounds[-1] + ENCODE_CHUNK_DURATION
+            near = [cut for cut in cuts if abs(cut - target) <= ENCODE_CHUNK_DURATION / 4]
+            bounds.append(min(near, key=lambda cut: abs(cut - target)) if near else target)
+        bounds.append(duration)
+        return [(i, start, end) for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:]))]
+
+    def _stitch_chunks(self, rungs, count):
+        """Joins the chunk playlists of each rendition into its `master.m3u8`."""
+        for rung in rungs:
+            resolution_folder = os.path.join(self.segments_folder, rung['name'])
+            entries, target_duration = [], 0
+            for i in range(count):
+                chunk_m3u8 = os.path.join(resolution_folder, f"chunk{i:04d}.m3u8")
+                with open(chunk_m3u8) as f:
+                    lines = [line.strip() for line in f.readlines()]
+                if i > 0:
+                    entries.append('#EXT-X-DISCONTINUITY')
+                for line in lines:
+                    if line.startswith('#EXT-X-TARGETDURATION:'):
+                        target_duration = max(target_duration, int(line.split(':')[1]))
+                    elif line.startswith('#EXTINF:') or (line and not line.startswith('#')):
+                        entries.append(line)
+            content = '#EXTM3U\n#EXT-X-VERSION:3\n#EXT-X-TARGETDURATION:{}\n#EXT-X-MEDIA-SEQUENCE:0\n' \
+                      '#EXT-X-PLAYLIST-TYPE:VOD\n'.format(target_duration)
+            content += '\n'.join(entries) + '\n#EXT-X-ENDLIST\n'
+            with open(os.path.join(resolution_folder, 'master.m3u8'), 'w') as f:
+                f.write(content)
+            # only removed once the stitched playlist is written, the stitch can be redone until then
+            for i in range(count):
+                os.remove(os.path.join(resolution_folder, f"chunk{i:04d}.m3u8"))
+
+    @staticmethod
+    def _chunk_queue():
+        """The `ENCODE_CHUNK_QUEUE` queue, None when no worker but the one running this job serves it.
+
+        A worker waiting for its chunks can't encode them, they are encoded here instead.
+        """
+        if not ENCODE_CHUNK_QUEUE:
+            return None
+        queue = Queue(ENCODE_CHUNK_QUEUE, connection=Redis(host=REDIS_HOST, port=REDIS_PORT))
+        job = get_current_job()
+        worker_name = job.worker_name if job is not None else None
+        if not any(worker.name != worker_name for worker in Worker.all(queue=queue)):
+            print('no other worker serves', ENCODE_CHUNK_QUEUE, ', encoding the chunks here')
+            return None
+        return queue
+
+    @staticmethod
+    def _chunk_job(queue, job_id):
+        """The chunk job `job_id` if it is still to run, running or finished, None otherwise."""
+        job = queue.fetch_job(job_id) if job_id else None
+        if job is None or job.get_status() not in ('queued', 'deferred', 'scheduled', 'started', 'finished'):
+            return None
+        return job
+
+    def _encode_chunked(self, rungs, media, manifest, cuts, duration):
+        """Encodes chunks of the source at the same time, locally or on the `ENCODE_CHUNK_QUEUE` workers.
+
+        Chunks finished by an interrupted encode are not encoded again.
+        """
+        chunks = self._chunks(cuts, duration)
+        if len(chunks) < 2:
+            return self._encode_single(rungs, media, manifest)
+        chunks_left = [chunk for chunk in chunks if not manifest.done('chunk:{}'.format(chunk[0]))]
+        queue = self._chunk_queue()
+        jobs = 1 if queue is not None else max(1, min(ENCODE_CHUNK_JOBS, len(chunks_left)))
+        threads = max(1, self.threads // (jobs * len(rungs)))
+        cmds = [self._single_cmd(rungs, media, threads, chunk) for chunk in chunks_left]
+        for chunk in chunks_left:
+            self._track('chunk{:04d}'.format(chunk[0]), rungs, chunk[2] - chunk[1])
+        if queue is not None:
+            # the jobs of an interrupted encode, still queued or running, are waited for instead of queued again
+            job_ids = manifest.get('chunk-jobs') or {}
+            queued = {}
+            for chunk, cmd in zip(chunks_left, cmds):
+                job = self._chunk_job(queue, job_ids.get(str(chunk[0])))
+                if job is None:
+                    job = queue.enqueue(run_encode_cmd, cmd, job_timeout=CHUNK_TIMEOUT)
+                    job_ids[str(chunk[0])] = job.id
+                queued[job] = chunk
+            manifest.complete('chunk-jobs', job_ids)
+            # as long as a single worker takes to encode them one after another
+            deadline = time.time() + CHUNK_TIMEOUT * len(queued)
+            # on failure the jobs are left to the retry, cancelling doesn't stop running ones
+            while queued:
+                if time.time() > deadline:
+                    raise RuntimeError('chunk encodes of {} timed out'.format(self.file_path))
+                time.sleep(1)
+                for job in list(queued):
+                    status = job.get_status()
+                    if status == 'finished':
+                        # the queued chunks only report when they are done
+                        chunk = queued.pop(job)
+                        manifest.complete('chunk:{}'.format(chunk[0]))
+                        if self.progress is not None:
+                            self.progress.complete('chunk{:04d}'.format(chunk[0]))
+                    elif status is None or status in ('failed', 'stopped', 'canceled'):
+                        # expired or deleted jobs have no status left
+                        raise RuntimeError('chunk encode {} {}'.format(job.id, status or 'is gone'))
+        else:
+            def encode_chunk(chunk, cmd):
+                self._run(cmd, 'chunk{:04d}'.format(chunk[0]))
+                manifest.complete('chunk:{}'.format(chunk[0]))
+
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                try:
+                    for _ in executor.map(encode_chunk, chunks_left, cmds):
+                        pass
+                except BaseException:
+                    # the executor waits for the other chunks before the error is raised
+                    self._kill()
+                    raise
+        self._stitch_chunks(rungs, len(chunks))
+        for rung in rungs:
+            manifest.complete('rendition:' + rung['name'])
+        return cmds
+
+    def _sprites(self, media):
+        """Filter and output of the seek preview sprite sheets of the source, None without them."""
+        if not SPRITE_INTERVAL or media is None or not media.width or not media.height:
+            return None
+        # decoded frames are rotated
+        width, height = (media.height, media.width) if media.rotation in (90, 270) else (media.width, media.height)
+        tile_width, tile_height = sprite_size(width, height)
+        return {
+            'width': tile_width,
+            'height': tile_height,
+            'filter': sprite_filter(tile_width, tile_height),
+            'output': sprite_output_args(self.sprites_folder),
+        }
+
+    def _sprite_track(self, sprites, duration):
+        """Writes `thumbnails.vtt` next to the master playlist, tiling the sprite sheets first if no pass did."""
+        try:
+            if not any(name.startswith('sprite_') for name in os.listdir(self.sprites_folder)):
+                cmd = [
+                    'ffmpeg',
+                    '-hide_banner', '-v', 'error',
+                    '-skip_loop_filter', 'all', '-flags2', '+fast',
+                    '-i', self.file_path,
+                    '-vf', sprites['filter'],
+                    '-an',
+                ] + sprites['output']
+                self._run(cmd)
+            write_sprite_track(self.sprites_file, self.sprites_folder, duration, sprites['width'], sprites['height'])
+            return True
+        except (subprocess.CalledProcessError, OSError) as e:
+            # the encode is usable without them
+            print(e)
+            return False
+
+    @staticmethod
+    def _master_playlist(rungs):
+        content = "#EXTM3U\n"
+        for rung in rungs:
+            if rung.get('audio_only'):
+                content += f"#EXT-X-STREAM-INF:BANDWIDTH={rung['bitrate']*1000},CODECS=\"mp4a.40.2\"\n"
+            else:
+                content += f"#EXT-X-STREAM-INF:BANDWIDTH={rung['bitrate']*1000},RESOLUTION={rung['width']}x{rung['height']}\n"
+            content += f"{rung['name']}/master.m3u8\n"
+        return content
+
+    def _encode_settings(self, rungs):
+        # an encode is only resumed with the settings it was started with
+        settings = {
+            'mode': self.encode_mode,
+            'rungs': rungs,
+            'videoCodec': self.video_codec,
+            'audioCodec': self.audio_codec,
+            'audioBitrate': str(self.audio_bitrate),
+            'fps': self.frames_per_sec,
+            'preset': self.preset,
+            'sceneCutThreshold': self.scene_cut_threshold,
+            'chapterDuration': self.chapter_duration,
+        }
+        if self.encode_mode == 'chunked':
+            settings['chunkDuration'] = ENCODE_CHUNK_DURATION
+        return settings
+
     def encode(self):
+        """Encodes the HLS renditions of the source.
+
+        Completed stages are checkpointed in the encode manifest, so when the job
+        is retried the scenes and finished renditions are kept and interrupted
+        renditions continue after their last complete segment. Failures, job
+        timeouts included, are raised again for the job to be retried.
+        """
         try:
             self.hooks['in_progress'](self.key)
-            shutil.rmtree(self.video_nft_folder, ignore_errors=True)
-            os.makedirs(self.video_nft_folder)
-            scenes_file = os.path.join(self.video_nft_folder, 'scenes.json')
-            scenes = self._get_scene_cuts()
             _, duration = info(self.file_path)
-            self._save_scenecuts(scenes, scenes_file, duration)
-            chapters = self._generate_chapters(scenes)
-
-            if len(chapters) == 0 or (len(chapters) and duration - chapters[-1] >= 3):
-                chapters.append(duration)
+            media = probe(self.file_path)
+            rungs = self.renditions(media)
+            manifest = EncodeManifest(self.video_nft_folder, self.file_path, self._encode_settings(rungs))
+            if manifest.valid:
+                print('resuming encode of', self.file_path)
+            else:
+                shutil.rmtree(self.video_nft_folder, ignore_errors=True)
+                os.makedirs(self.video_nft_folder)
+                manifest.save()
+            for rung in rungs:
+                # finished by the interrupted job before it could be checkpointed
+                if not manifest.done('rendition:' + rung['name']) and self._read_playlist(rung)[2]:
+                    manifest.complete('rendition:' + rung['name'])
+            rungs_left = [rung for rung in rungs if not manifest.done('rendition:' + rung['name'])]
+            # the sprite sheets are tiled again when their layout changed
+            sprites = self._sprites(media)
+            if sprites is not None and manifest.get('sprites') == sprites['filter']:
+                sprites = None
+            if sprites is not None:
+                shutil.rmtree(self.sprites_folder, ignore_errors=True)
+                os.makedirs(self.sprites_folder)
+            progress_hook = self.hooks.get('progress')
+            self.progress = EncodeProgress(self.progress_file,
+                                           progress_hook and (lambda progress: progress_hook(self.key, progress)))
 
-            chapters_file = os.path.join(self.video_nft_folder, 'chapters.json')
-            with open(chapters_file, 'w', encoding='utf-8') as file:
-                json.dump(chapters, file, ensure_ascii=False, indent=4)
-            segments = self._get_segments(chapters)
+            # single mode scores the scenes while encoding, the other modes beforehand. So
+            # does a resumed single encode, as it doesn't decode the start of the source again
+            scenes = manifest.get('scenes')
+            scene_scores_file = os.path.join(self.video_nft_folder, 'scene_scores.txt')
+            resumed = any(self._read_playlist(rung)[1] for rung in rungs_left)
+            if scenes is None and (self.encode_mode != 'single' or not rungs_left or resumed):
+                scenes = self._scenes_stage(self._get_scene_cuts(sprites), duration)
+                manifest.complete('scenes', scenes)
             meta = {
                 'assetID': self.key['_id'],
                 'duration': duration,
@@ -293,124 +1106,116 @@ class FFMPEG:
             if not os.path.exists(self.segments_folder):
                 os.makedirs(self.segments_folder)
 
-            resolutions = {
-                "720p": {"width": 1280, "height": 720, "bitrate": 3000},
-                "1080p": {"width": 1920, "height": 1080, "bitrate": 5000},
-            }
-
-            master_playlist_content = "#EXTM3U\n"
-
-            for resolution, config in resolutions.items():
-                resolution_folder = os.path.join(self.segments_folder, resolution)
-                os.makedirs(resolution_folder, exist_ok=True)
-
-                vf = f"scale={config['width']}:{config['height']}"
-                output_m3u8 = f"{resolution_folder}/master.m3u8"
-                segment_filename = f"{resolution_folder}/seg_%05d.ts"
-
-                encode_cmd = [
-                    'ffmpeg',
-                    '-hide_banner', '-v', 'error',
-                    '-f', 'lavfi', '-i', 'aevalsrc=0',
-                    '-i', self.file_path,
-                    '-vf', vf,
-                    '-vcodec', self.video_codec,
-                    '-r', str(self.frames_per_sec),
-                    '-g', str(self.frames_per_sec * 2),
-                    '-crf', '22',
-                    '-preset', self.preset,
-                    '-keyint_min', str(self.frames_per_sec * 2),
-                    '-maxrate', str(config['bitrate']) + 'k',
-                    '-b:v', str(config['bitrate']) + 'k',
-                    '-acodec', self.audio_codec,
-                    '-ar', '44100',
-                    '-ac', '2',
-                    '-b:a', str(self.audio_bitrate) + 'k',
-                    '-shortest',
-                    '-f', 'hls',
-                    '-hls_time', '4',
-                    '-hls_playlist_type', 'vod',
-                    '-hls_list_size', '0',
-                    '-hls_segment_filename', segment_filename,
-                    '-tune', 'fastdecode',
-                    '-tune', 'zerolatency',
-                    '-max_muxing_queue_size', '1024',
-                    '-max_interleave_delta', '0',
-                    '-reset_timestamps', '1',
-                    '-async', '1',
-                    '-y', output_m3u8
-                ]
-
-                print(' '.join(encode_cmd))
-                subprocess.check_call(encode_cmd)
-
-                master_playlist_content += f"#EXT-X-STREAM-INF:BANDWIDTH={config['bitrate']*1000},RESOLUTION={config['width']}x{config['height']}\n"
-                master_playlist_content += f"{resolution}/master.m3u8\n"
+            if not rungs_left:
+                pass
+            elif self.encode_mode == 'chunked':
+                self._encode_chunked(rungs_left, media, manifest, scenes['cuts'], duration)
+            elif self.encode_mode == 'single':
+                self._encode_single(rungs_left, media, manifest, scene_scores_file if scenes is None else None,
+                                    sprites if scenes is None else None)
+            elif self.encode_mode == 'parallel':
+                self._encode_parallel(rungs_left, media, manifest)
+            else:
+                self._encode_serial(rungs_left, media, manifest)
+            for rung in rungs:
+                self._repair_rendition(rung, media, manifest, duration)
+            if scenes is None:
+                scenes = self._scenes_stage(self._read_scene_scores(scene_scores_file), duration)
+                manifest.complete('scenes', scenes)
+            segments = scenes['segments']
+            if sprites is not None and self._sprite_track(sprites, duration):
+                manifest.complete('sprites', sprites['filter'])
 
+            master_playlist_content = self._master_playlist(rungs)
             master_playlist_content += "#EXT-X-ENDLIST\n"
             master_playlist_path = os.path.join(self.segments_folder, "master.m3u8")
             with open(master_playlist_path, "w") as master_playlist:
                 master_playlist.write(master_playlist_content)
-            
-            lower_resolution_file_path = os.path.join(self.segments_folder, "720p/master.m3u8")
-            if not is_valid_encode(self.file_path, lower_resolution_file_path) or not self._check_m3u8():
-                print('not a valid encode, re-encoding file')
-                subprocess.check_call(encode_cmd)
-            
+
             path_parts = self.m3u8_file.split('media-node-data/assets/')
             if len(path_parts) > 1:
                 m3u8_file_path = '/assets/' + path_parts[1]
             else:
                 m3u8_file_path = self.m3u8_file
                 
+            self.progress.finish()
             self.hooks['complete'](self.key, segments, m3u8_file_path)
             return self.segments_folder
         except Exception as e:
             print(e)
+            self._kill()
+            if self.progress is not None:
+                self.progress.finish('ERROR')
             self.hooks['error'](self.key)
+            raise
     
     def encode_default_stream(self):
         try:
             if not os.path.exists(self.segments_folder):
                 os.makedirs(self.segments_folder)
 
-            vf = 'scale={0}:{1},setsar=1'.format(self.width, self.height)
-
+            media = probe(self.file_path)
+            copy = self._passthrough(media, self.width, self.height, int(self.video_bitrate), segmented=False)
             encode_cmd = [
                 'ffmpeg',
                 '-hide_banner', '-v', 'error',
                 '-f', 'lavfi', '-i', 'aevalsrc=0',
                 '-i', self.file_path,
-                '-vf', vf,
-                '-vcodec', self.video_codec,
-                '-r', str(self.frames_per_sec),
-                '-g', str(self.frames_per_sec * 2),
-                '-crf', '22',
-                '-preset', self.preset,
-                '-keyint_min', str(self.frames_per_sec * 2),
-                '-maxrate', str(self.video_bitrate) + 'k',
-                '-b:v', str(self.video_bitrate) + 'k',
-                '-acodec', self.audio_codec,
-                '-ar', '44100',
-                '-ac', '2',
-                '-b:a', str(self.audio_bitrate) + 'k',
-                '-shortest',
+            ]
+            if copy:
+                # remuxed, the source is already what the encode would produce
+                encode_cmd += ['-map', '1:v:0', '-map', self._audio_map(media), '-c:v', 'copy']
+            else:
+                vf = 'scale={0}:{1},setsar=1'.format(self.width, self.height)
+                encode_cmd += [
+                    '-vf', vf,
+                    '-vcodec', self.video_codec,
+                    '-r', str(self.frames_per_sec),
+                    '-g', str(self.frames_per_sec * 2),
+                    '-crf', '22',
+                    '-preset', self.preset,
+                    '-keyint_min', str(self.frames_per_sec * 2),
+                    '-maxrate', str(self.video_bitrate) + 'k',
+                    '-b:v', str(self.video_bitrate) + 'k',
+                ]
+            if 'audio' in copy:
+                encode_cmd += ['-c:a', 'copy']
+            else:
+                encode_cmd += [
+                    '-acodec', self.audio_codec,
+                    '-ar', '44100',
+                    '-ac', '2',
+                    '-b:a', str(self.audio_bitrate) + 'k',
+                ]
+            if not copy or self._audio_map(media) == '0:a':
+                encode_cmd += ['-shortest']
+            encode_cmd += [
                 '-f', 'mp4',
                 '-movflags', '+faststart',
-                '-tune', 'fastdecode',
-                '-tune', 'zerolatency',
+            ]
+            if not copy:
+                encode_cmd += [
+                    '-tune', 'fastdecode',
+                    '-tune', 'zerolatency',
+                ]
+            encode_cmd += [
                 '-max_muxing_queue_size', '1024',
                 '-max_interleave_delta', '0',
                 '-reset_timestamps', '1',
                 '-async', '1',
                 '-y', str(self.mp4_file)
             ]
-            print(' '.join(encode_cmd))
-            subprocess.check_call(encode_cmd)
+            self.progress = EncodeProgress(os.path.join(self.destination_path, 'default_progress.json'))
+            self.progress.add('default', ['default'], info(self.file_path)[1])
+            self._run(encode_cmd, 'default')
             if not is_valid_encode(self.file_path, self.mp4_file):
                 print('not a valid encode, re-encoding file')
-                subprocess.check_call(encode_cmd)
+                self.progress.add('default', ['default'], info(self.file_path)[1])
+                self._run(encode_cmd, 'default')
+            self.progress.finish()
             return self.mp4_file
         except Exception as e:
             print(e)
+            if self.progress is not None:
+                self.progress.finish('ERROR')
     
@@ -0,0 +1,141 @@
+# coding: utf-8
+import json
+import os
+import threading
+import time
+
+from rq.timeouts import JobTimeoutException
+
+from ..config import ENCODE_PROGRESS_INTERVAL
+
+
+def parse_progress(block):
+    """Reads the out time, in seconds, fps and speed of an ffmpeg `-progress` block."""
+    def number(value):
+        try:
+            return float((value or '').rstrip('x'))
+        except ValueError:
+            return 0.0
+
+    # out_time_ms is in microseconds as well
+    out_time = number(block.get('out_time_us') or block.get('out_time_ms')) / 1000000
+    return max(0.0, out_time), number(block.get('fps')), number(block.get('speed'))
+
+
+def estimate(duration, out_time, speed):
+    remaining = max(0.0, duration - out_time)
+    return {
+        'progress': round(100 * out_time / duration, 1) if duration else 0.0,
+        'eta': round(remaining / speed, 1) if speed > 0 else (0 if duration and not remaining else None),
+    }
+
+
+class EncodeProgress:
+    """Progress of the ffmpeg processes of an encode.
+
+    Every process is a task encoding `duration` seconds of the source into one or
+    more renditions. The progress of each rendition is written to `progress_file`
+    on every update and passed to `hook` at most every `interval` seconds.
+    """
+
+    def __init__(self, progress_file, hook=None, interval=None):
+        self.progress_file = progress_file
+        self.hook = hook
+        self.interval = ENCODE_PROGRESS_INTERVAL if interval is None else interval
+        self.lock = threading.Lock()
+        self.tasks = {}
+        self.started_at = time.time()
+        self.hooked_at = 0
+        self.status = 'PROCESSING'
+
+    def add(self, name, renditions, duration):
+        with self.lock:
+            self.tasks[name] = {
+                'renditions': list(renditions),
+                'duration': max(0.0, float(duration or 0)),
+                'outTime': 0.0,
+                'fps': 0.0,
+                'speed': 0.0,
+                'running': False,
+            }
+
+    def callback(self, name):
+        return lambda block: self.update(name, block)
+
+    def update(self, name, block):
+        out_time, fps, speed = parse_progress(block)
+        with self.lock:
+            task = self.tasks[name]
+            task['outTime'] = min(out_time, task['duration']) if task['duration'] else out_time
+            task['fps'] = fps
+            task['speed'] = speed
+            task['running'] = block.get('progress') != 'end'
+            if not task['running']:
+                task['outTime'] = task['duration']
+        self.report()
+
+    def complete(self, name):
+        with self.lock:
+            task = self.tasks[name]
+            task['outTime'], task['running'] = task['duration'], False
+        self.report()
+
+    def finish(self, status='COMPLETE'):
+        with self.lock:
+            self.status = status
+            for task in self.tasks.values():
+                task['running'] = False
+        self.report(force=True)
+
+    def state(self):
+        renditions = {}
+        for task in self.tasks.values():
+            for name in task['renditions']:
+                rendition = renditions.setdefault(name, {'duration': 0.0, 'outTime': 0.0, 'fps': 0.0, 'speed': 0.0})
+                rendition['duration'] += task['duration']
+                rendition['outTime'] += task['outTime']
+                if task['running']:
+                    rendition['fps'] += task['fps']
+                    rendition['speed'] += task['speed']
+        for rendition in renditions.values():
+            rendition.update(estimate(rendition['duration'], rendition['outTime'], rendition['speed']))
+            rendition['outTime'] = round(rendition['outTime'], 2)
+            rendition['speed'] = round(rendition['speed'], 2)
+            rendition['fps'] = round(rendition['fps'], 2)
+        # renditions encoded by one process share its speed, so the totals are per task
+        duration = sum(task['duration'] for task in self.tasks.values())
+        out_time = sum(task['outTime'] for task in self.tasks.values())
+        speed = sum(task['speed'] for task in self.tasks.values() if task['running'])
+        progress = {
+            'status': self.status,
+            'elapsed': round(time.time() - self.started_at, 1),
+            'updatedAt': time.time(),
+            'speed': round(speed, 2),
+            'renditions': renditions,
+        }
+        progress.update(estimate(duration, out_time, speed))
+        if self.status == 'COMPLETE':
+            progress.update(progress=100.0, eta=0)
+        return progress
+
+    def report(self, force=False):
+        with self.lock:
+            progress = self.state()
+            hook = self.hook is not None and (force or progress['updatedAt'] - self.hooked_at >= self.interval)
+            if hook:
+                self.hooked_at = progress['updatedAt']
+            try:
+                temp_file = self.progress_file + '~'
+                with open(temp_file, 'w') as f:
+                    json.dump(progress, f)
+                os.replace(temp_file, self.progress_file)
+            except OSError as e:
+                print(e)
+        if hook:
+            # a failing backend doesn't stop the encode
+            try:
+                self.hook(progress)
+            except JobTimeoutException:
+                raise
+            except Exception as e:
+                print(e)
@@ -0,0 +1,170 @@
+# coding: utf-8
+import json
+import math
+import os
+import subprocess
+
+import numpy as np
+
+from ..config import THUMBNAIL_CANDIDATES, SPRITE_INTERVAL, SPRITE_WIDTH, SPRITE_COLUMNS, SPRITE_ROWS
+
+# candidate frames are scored at this size
+SCORE_WIDTH = 160
+SCORE_HEIGHT = 90
+
+
+def thumbnail_sizes(width, height):
+    """Sizes of the horizontal, vertical and square thumbnails of a `width`x`height` frame."""
+    return {
+        'horizontal': (width, height),
+        'vertical': (height, width),
+        'square': (height, height),
+    }
+
+
+def extract_thumbnails(file_path, destination, name, sizes, seek=0):
+    """Writes `<name>_<orientation>.jpg` thumbnails of one frame of `file_path`, returns their paths.
+
+    The input is seeked to `seek` seconds before it is decoded, so decoding
+    starts at the keyframe before the frame, and the frame is split, scaled and
+    cropped to every one of `sizes` in the same ffmpeg process.
+    """
+    if not os.path.exists(destination):
+        os.makedirs(destination)
+    graph = '[0:v]split={0}{1}'.format(len(sizes), ''.join('[s{}]'.format(i) for i in range(len(sizes))))
+    outputs, thumbnails = [], {}
+    for i, (orientation, (width, height)) in enumerate(sizes.items()):
+        # filled and cropped rather than stretched to the size
+        graph += ';[s{0}]scale={1}:{2}:force_original_aspect_ratio=increase,crop={1}:{2},setsar=1[t{0}]'.format(
+            i, width, height)
+        thumbnails[orientation] = os.path.join(destination, '{}_{}.jpg'.format(name, orientation))
+        outputs += ['-map', '[t{}]'.format(i), '-frames:v', '1', '-update', '1', thumbnails[orientation]]
+    cmd = ['ffmpeg', '-y', '-hide_banner', '-v', 'error']
+    if seek:
+        # images have no frame to seek to, even at 0
+        cmd += ['-ss', str(seek)]
+    cmd += ['-i', file_path, '-filter_complex', graph] + outputs
+    for path in thumbnails.values():
+        # left in place when there is no frame to write
+        if os.path.exists(path):
+            os.remove(path)
+    print(' '.join(cmd))
+    subprocess.check_call(cmd)
+    missing = [path for path in thumbnails.values() if not os.path.isfile(path)]
+    if missing:
+        raise RuntimeError('no frame at {}s of {}'.format(seek, file_path))
+    return thumbnails
+
+
+def thumbnail_candidates(duration, scenes_file=None, count=THUMBNAIL_CANDIDATES):
+    """Times to pick a thumbnail at, the middles of the longest scenes then times spread over the source.
+
+    Times in the middle of scenes are away from the cuts, where fades and
+    transitions are.
+    """
+    scenes = []
+    if scenes_file and os.path.isfile(scenes_file):
+        try:
+            with open(scenes_file, 'r') as f:
+                scenes = json.load(f)
+        except (OSError, ValueError) as e:
+            print(e)
+    scenes = sorted(scenes, key=lambda scene: scene.get('duration', 0), reverse=True)
+    times = [scene['start_time'] + scene['duration'] / 2 for scene in scenes if scene.get('duration', 0) > 0]
+    times += [duration * (i + 1) / (count + 1) for i in range(count)]
+    candidates = []
+    for time in times:
+        time = round(min(time, duration), 3)
+        if time not in candidates:
+            candidates.append(time)
+    return sorted(candidates[:count])
+
+
+def decode_frames(file_path, times):
+    """Decodes the frames at `times` as small grayscale images, seeking to each of them in one ffmpeg process."""
+    cmd = ['ffmpeg', '-hide_banner', '-v', 'error']
+    for time in times:
+        cmd += ['-ss', str(time), '-i', file_path]
+    graph = ';'.join('[{0}:v]trim=end_frame=1,scale={1}:{2},setsar=1,format=gray[f{0}]'.format(
+        i, SCORE_WIDTH, SCORE_HEIGHT) for i in range(len(times)))
+    # one frame after another, every one kept whatever its timestamp
+    graph += ';{0}concat=n={1}:v=1:a=0,setpts=N/TB[frames]'.format(
+        ''.join('[f{}]'.format(i) for i in range(len(times))), len(times))
+    cmd += ['-filter_complex', graph, '-map', '[frames]', '-fps_mode', 'passthrough', '-f', 'rawvideo', 'pipe:1']
+    output = subprocess.check_output(cmd)
+    count = len(output) // (SCORE_WIDTH * SCORE_HEIGHT)
+    frames = np.frombuffer(output, dtype=np.uint8, count=count * SCORE_WIDTH * SCORE_HEIGHT)
+    return frames.reshape(count, SCORE_HEIGHT, SCORE_WIDTH)
+
+
+def frame_score(frame):
+    """Scores a grayscale frame by its exposure, contrast and sharpness, black and blurred frames score 0."""
+    frame = frame.astype(np.float32) / 255
+    # 1 for a mid gray average, 0 for black or white frames
+    exposure = 1 - abs(float(frame.mean()) - 0.5) * 2
+    contrast = float(frame.std())
+    laplacian = 4 * frame[1:-1, 1:-1] - frame[:-2, 1:-1] - frame[2:, 1:-1] - frame[1:-1, :-2] - frame[1:-1, 2:]
+    sharpness = float(np.sqrt(laplacian.var()))
+    return exposure * contrast * sharpness
+
+
+def select_thumbnail_time(file_path, duration, scenes_file=None):
+    """Picks the time of the best candidate frame for a thumbnail, the same one for the same source."""
+    if not duration:
+        return 0
+    times = thumbnail_candidates(duration, scenes_file)
+    try:
+        frames = decode_frames(file_path, times)
+    except (subprocess.CalledProcessError, OSError) as e:
+        print(e)
+        return 0
+    if not len(frames):
+        # single images have a duration but no frame after their first
+        return 0
+    if len(frames) != len(times):
+        # a candidate had no frame, the scores can't be matched to the times
+        return times[0]
+    scores = [frame_score(frame) for frame in frames]
+    return times[int(np.argmax(scores))]
+
+
+def sprite_size(width, height, tile_width=SPRITE_WIDTH):
+    """Size of the sprite sheet tiles of a `width`x`height` source, with an even height."""
+    return tile_width, max(2, int(round(tile_width * height / width / 2)) * 2)
+
+
+def sprite_filter(tile_width, tile_height, interval=SPRITE_INTERVAL):
+    """Filter tiling a frame every `interval` seconds into sprite sheets."""
+    return 'fps=1/{0},scale={1}:{2},setsar=1,tile={3}x{4}'.format(interval, tile_width, tile_height, SPRITE_COLUMNS,
+                                                                 SPRITE_ROWS)
+
+
+def sprite_output_args(folder):
+    return ['-fps_mode', 'passthrough', '-q:v', '4', '-f', 'image2', os.path.join(folder, 'sprite_%03d.jpg')]
+
+
+def vtt_time(seconds):
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(int(minutes), 60)
+    return '{:02d}:{:02d}:{:06.3f}'.format(hours, minutes, seconds)
+
+
+def write_sprite_track(vtt_file, folder, duration, tile_width, tile_height, interval=SPRITE_INTERVAL):
+    """Writes a WebVTT track of the tiles of the sprite sheets in `folder`, a cue every `interval` seconds.
+
+    Each cue is the sheet relative to `vtt_file` with the tile as a `#xywh` fragment.
+    """
+    sheets = sorted(name for name in os.listdir(folder) if name.startswith('sprite_') and name.endswith('.jpg'))
+    tiles = SPRITE_COLUMNS * SPRITE_ROWS
+    count = min(int(math.ceil(duration / interval)), len(sheets) * tiles)
+    sheets_path = os.path.relpath(folder, os.path.dirname(vtt_file))
+    content = 'WEBVTT\n'
+    for i in range(count):
+        sheet, tile = divmod(i, tiles)
+        row, column = divmod(tile, SPRITE_COLUMNS)
+        content += '\n{} --> {}\n{}/{}#xywh={},{},{},{}\n'.format(
+            vtt_time(i * interval), vtt_time(min((i + 1) * interval, duration)), sheets_path, sheets[sheet],
+            column * tile_width, row * tile_height, tile_width, tile_height)
+    with open(vtt_file, 'w') as f:
+        f.write(content)
+    return count
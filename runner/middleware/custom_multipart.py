@@ -2,6 +2,16 @@ from falcon_multipart.middleware import MultipartMiddleware
 from io import BytesIO
 
 class CustomMultipartMiddleware(MultipartMiddleware):
+    def process_request(self, req, resp, **kwargs):
+        # parsing is deferred until the resource is known, see process_resource
+        pass
+
+    def process_resource(self, req, resp, resource, params):
+        # resources with `multipart_streaming` parse the body themselves
+        if getattr(resource, 'multipart_streaming', False):
+            return
+        super().process_request(req, resp)
+
     def parse_field(self, field):
         if field.filename:
             return field
@@ -4,6 +4,7 @@ from .stats import router as stats_router
 from .status import router as status_router
 from .twitter import router as twitter_router
 from .streamer import router as streamer_router
+from .upload import router as upload_router
 
 
 def router(app):
@@ -12,3 +13,4 @@ def router(app):
     status_router(app)
     streamer_router(app)
     twitter_router(app)
+    upload_router(app)
@@ -1,6 +1,7 @@
 # coding: utf-8
 from ..controller.file import AssetFiles, AddAssetFile, AssetFileDownload, AssetFileDelete, FileUpload,\
-    AssetFileUpload, AddAssetFileToIpfs, AllowedFileTypes, AssetFileEncode, UploadAssetThumbnail, AddDefaultStream, GetDefaultStream
+    AssetFileUpload, AddAssetFileToIpfs, AllowedFileTypes, AssetFileEncode, UploadAssetThumbnail, AddDefaultStream, GetDefaultStream, \
+    AssetFileEncodeProgress, DefaultStreamProgress
 
 def router(app):
     app.add_route('/runner/users/{userid}/files', AssetFiles())
@@ -12,6 +13,8 @@ def router(app):
     app.add_route('/runner/users/{userid}/assets/{asset_id}/add-to-ipfs', AddAssetFileToIpfs())
     app.add_route('/runner/allowed-file-types', AllowedFileTypes())
     app.add_route('/runner/users/{userid}/assets/{asset_id}/encode', AssetFileEncode())
+    app.add_route('/runner/users/{userid}/assets/{asset_id}/encode-progress', AssetFileEncodeProgress())
     app.add_route('/runner/users/{userid}/upload-thumbnail', UploadAssetThumbnail())
     app.add_route('/runner/users/{userid}/add-default-stream', AddDefaultStream())
     app.add_route('/runner/users/{userid}/get-default-stream', GetDefaultStream())
+    app.add_route('/runner/users/{userid}/default-stream-progress', DefaultStreamProgress())
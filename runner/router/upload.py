@@ -0,0 +1,8 @@
+# coding: utf-8
+from ..controller.upload import Uploads, Upload, UploadFinalize
+
+
+def router(app):
+    app.add_route('/runner/users/{userid}/uploads', Uploads())
+    app.add_route('/runner/users/{userid}/uploads/{upload_id}', Upload())
+    app.add_route('/runner/users/{userid}/uploads/{upload_id}/finalize', UploadFinalize())
@@ -0,0 +1,232 @@
+# coding: utf-8
+import os
+import re
+import time
+from urllib.parse import quote
+from email.utils import formatdate, parsedate_to_datetime
+
+from falcon import HTTP_200, HTTP_206, HTTP_304, HTTP_416
+from ..config import DOWNLOAD_MODE, ACCEL_REDIRECT_LOCATION, DOWNLOAD_CACHE_CONTROL
+
+BLOCK_SIZE = 1024 * 1024  # 1MB
+# ascii digits only, str.isdigit() also accepts digits int() rejects
+BYTE_POS = re.compile(r'[0-9]+')
+
+
+def parse_range(header, size):
+    """Parses a `Range` header into a list of (start, end) byte pairs (inclusive).
+
+    Returns None when the header is missing, malformed or not in bytes units
+    (the whole file is served) and an empty list when none of the ranges can
+    be satisfied.
+    """
+    if not header:
+        return None
+    units, _, ranges_spec = header.partition('=')
+    if units.strip().lower() != 'bytes' or not ranges_spec.strip():
+        return None
+
+    ranges = []
+    for spec in ranges_spec.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        first, sep, last = spec.partition('-')
+        first, last = first.strip(), last.strip()
+        if not sep or not (first or last) or any(pos and not BYTE_POS.fullmatch(pos) for pos in (first, last)):
+            return None
+        if not first:
+            # suffix range, the last N bytes
+            length = int(last)
+            # nothing to take the last bytes of in an empty file
+            if length == 0 or size == 0:
+                continue
+            ranges.append((max(size - length, 0), size - 1))
+            continue
+        start = int(first)
+        end = int(last) if last else size - 1
+        if last and end < start:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, min(end, size - 1)))
+
+    return merge_ranges(ranges)
+
+
+def merge_ranges(ranges, inclusive=True):
+    """Sorts and merges overlapping or adjacent (start, end) ranges.
+
+    Ends are inclusive, as in `Range` headers, or exclusive when `inclusive` is False.
+    """
+    gap = 1 if inclusive else 0
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + gap:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def file_etag(stat):
+    return '"{:x}-{:x}-{:x}"'.format(stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def http_date(timestamp):
+    return formatdate(timestamp, usegmt=True)
+
+
+def is_not_modified(req, stat, etag):
+    """Evaluates `If-None-Match` (weak comparison) and, without it, `If-Modified-Since`."""
+    if_none_match = req.get_header('If-None-Match')
+    if if_none_match:
+        if if_none_match.strip() == '*':
+            return True
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return etag.replace('W/', '') in [tag.replace('W/', '') for tag in tags]
+
+    if_modified_since = req.get_header('If-Modified-Since')
+    if if_modified_since:
+        try:
+            return int(stat.st_mtime) <= int(parsedate_to_datetime(if_modified_since).timestamp())
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def is_range_fresh(if_range, stat, etag):
+    """Checks the `If-Range` validator, a strong ETag or an HTTP date."""
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"'):
+        return if_range == etag
+    if if_range.startswith('W/'):
+        return False
+    try:
+        return int(parsedate_to_datetime(if_range).timestamp()) == int(stat.st_mtime)
+    except (TypeError, ValueError):
+        return False
+
+
+class RangeReader:
+    """File-like wrapper that reads at most `length` bytes from `start`."""
+
+    def __init__(self, f, start, length):
+        self.f = f
+        self.f.seek(start)
+        self.remaining = length
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        chunk = self.f.read(size)
+        self.remaining -= len(chunk)
+        return chunk
+
+    def close(self):
+        self.f.close()
+
+
+def iter_multipart_ranges(f, ranges, parts):
+    try:
+        for (start, end), head in zip(ranges, parts):
+            yield head
+            reader = RangeReader(f, start, end - start + 1)
+            while True:
+                chunk = reader.read(BLOCK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+            yield b'\r\n'
+        yield parts[-1]
+    finally:
+        f.close()
+
+
+def accel_redirect(res, file_path, content_type):
+    res.status = HTTP_200
+    res.set_header('Content-Type', content_type)
+    res.set_header('X-Accel-Redirect', ACCEL_REDIRECT_LOCATION.rstrip('/') + quote(os.path.abspath(file_path)))
+
+
+def send_file(req, res, file_path, content_type=None, mode=None, etag=None, cache_control=None):
+    """Streams `file_path` honouring `Range`, `If-Range` and conditional request headers.
+
+    Responses carry `ETag` (from inode/size/mtime unless a content-hash `etag` is
+    given), `Last-Modified` and `Cache-Control`; a matching `If-None-Match` or
+    `If-Modified-Since` is answered with 304. Single ranges are answered with a 206
+    and a `Content-Range` header, multiple ranges with a `multipart/byteranges`
+    body and unsatisfiable ranges with 416.
+    In 'sendfile' mode full and single-range bodies are handed to the server as the
+    open file, positioned at the range start and bounded by `Content-Length`, so
+    `wsgi.file_wrapper` can use sendfile(2); in 'accel' mode nginx serves the file.
+    Raises IOError if the file can't be opened.
+    """
+    mode = mode or DOWNLOAD_MODE
+    content_type = content_type or 'application/octet-stream'
+    stat = os.stat(file_path)
+    etag = etag or file_etag(stat)
+
+    res.set_header('ETag', etag)
+    res.set_header('Last-Modified', http_date(stat.st_mtime))
+    res.set_header('Cache-Control', cache_control or DOWNLOAD_CACHE_CONTROL)
+
+    if is_not_modified(req, stat, etag):
+        res.status = HTTP_304
+        return
+
+    if mode == 'accel':
+        accel_redirect(res, file_path, content_type)
+        return
+
+    f = open(file_path, 'rb')
+    size = stat.st_size
+
+    res.set_header('Accept-Ranges', 'bytes')
+
+    ranges = None
+    if is_range_fresh(req.get_header('If-Range'), stat, etag):
+        ranges = parse_range(req.get_header('Range'), size)
+
+    if ranges is None:
+        res.status = HTTP_200
+        res.set_header('Content-Type', content_type)
+        res.content_length = size
+        res.stream = f
+        return
+
+    if not ranges:
+        f.close()
+        res.status = HTTP_416
+        res.set_header('Content-Range', 'bytes */{}'.format(size))
+        res.content_length = 0
+        return
+
+    res.status = HTTP_206
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        res.set_header('Content-Type', content_type)
+        res.set_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+        res.content_length = end - start + 1
+        if mode == 'sendfile':
+            f.seek(start)
+            res.stream = f
+        else:
+            res.stream = RangeReader(f, start, end - start + 1)
+        return
+
+    boundary = '{:x}{:x}'.format(int(time.time() * 1000000), stat.st_ino)
+    parts = []
+    for start, end in ranges:
+        parts.append('--{}\r\nContent-Type: {}\r\nContent-Range: bytes {}-{}/{}\r\n\r\n'.format(
+            boundary, content_type, start, end, size).encode('utf-8'))
+    parts.append('--{}--\r\n'.format(boundary).encode('utf-8'))
+
+    length = sum(len(part) for part in parts) + sum(end - start + 1 + 2 for start, end in ranges)
+    res.set_header('Content-Type', 'multipart/byteranges; boundary={}'.format(boundary))
+    res.content_length = length
+    res.stream = iter_multipart_ranges(f, ranges, parts)
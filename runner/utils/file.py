@@ -1,36 +1,14 @@
 # coding: utf-8
-from concurrent.futures import ThreadPoolExecutor
 import os
 from pathlib import Path
 import psutil
 import fleep
 import random
 import re
+import shutil
 import string
 from ..lib import ff_probe
-
-
-def media_files(directory, exclude, pattern='*'):
-    _files = []
-    paths = []
-    for path in Path(directory).rglob(pattern):
-        if path.is_file() and str(path).replace(directory + '/', '') not in exclude:
-            paths.append(path)
-
-    with ThreadPoolExecutor() as executor:
-        results = executor.map(media_file, paths)
-        for result in results:
-            if result is not None:
-                file = {
-                    'name': result['name'],
-                    'path': result['parent'].replace(directory + '/', ''),
-                    'size': result['size'],
-                    'MIMEType': result['mime'],
-                    'length': result['duration'],
-                }
-                _files.append(file)
-
-    return _files
+from ..config import ROOT_DIRECTORY, ENCODE_DURATION_TOLERANCE
 
 
 def list_files(directory, pattern='*.mp4'):
@@ -82,11 +60,48 @@ def media_file(path):
     return meta
 
 
+def media_root(root_path):
+    if root_path:
+        return os.path.join(root_path, 'media-node-data')
+    return ROOT_DIRECTORY
+
+
+def link_tree(source, destination, ignore=None):
+    """Hard links the files under `source` into `destination`, copying them across filesystems.
+
+    Files written again later, with a new inode, are not changed in the other tree.
+    """
+    def link(src, dst):
+        if os.path.lexists(dst):
+            os.remove(dst)
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
+    shutil.copytree(source, destination, ignore=ignore, copy_function=link, dirs_exist_ok=True)
+
+
+def unique_file_path(directory, filename):
+    # '~' files are uploads still being written
+    name, extension = os.path.splitext(filename)
+    file_path = os.path.join(directory, filename)
+    count = 1
+    while os.path.exists(file_path) or os.path.exists(file_path + '~'):
+        file_path = os.path.join(directory, '{}_{}{}'.format(name, count, extension))
+        count += 1
+    return file_path
+
+
 def get_disk_usage(disk_path):
     disk = psutil.disk_usage(disk_path)
     return disk.percent
 
 
+def get_free_space(disk_path):
+    return psutil.disk_usage(disk_path).free
+
+
 def get_cpu_usage():
     return psutil.cpu_percent()
 
@@ -95,10 +110,11 @@ def get_ram_usage():
     return psutil.virtual_memory().percent
 
 
-def is_valid_encode(input_file, output_file):
+def is_valid_encode(input_file, output_file, tolerance=ENCODE_DURATION_TOLERANCE):
+    # containers round and pad durations differently, so they only need to be close
     input_size, input_duration = ff_probe.info(input_file)
     output_size, output_duration = ff_probe.info(output_file)
-    return int(input_duration) <= int(output_duration)
+    return output_duration > 0 and input_duration - output_duration <= tolerance
 
 
 def file_type(file_path):
@@ -112,7 +128,8 @@ def is_valid_user_id(user_id):
     # Define the pattern for a valid MongoDB ID (ObjectID)
     pattern = re.compile(r'^[0-9a-fA-F]{24}$')
 
-    if pattern.match(user_id):
+    # fullmatch, '$' also matches before a trailing newline
+    if pattern.fullmatch(user_id or ''):
         return True
     else:
         return False
@@ -0,0 +1,255 @@
+# coding: utf-8
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from .file import media_file
+
+INDEX_DIRECTORY = '.index'
+INDEX_FILE = 'index.db'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    digest TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    asset_id TEXT,
+    result TEXT,
+    created_at REAL
+);
+CREATE INDEX IF NOT EXISTS files_path ON files (path);
+CREATE TABLE IF NOT EXISTS file_assets (
+    digest TEXT NOT NULL,
+    asset_id TEXT NOT NULL,
+    PRIMARY KEY (digest, asset_id)
+);
+CREATE TABLE IF NOT EXISTS media (
+    path TEXT PRIMARY KEY,
+    parent TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER,
+    mime TEXT,
+    duration REAL,
+    stat_size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+'''
+
+
+def connect(media_path):
+    """Opens the index database kept in `<media_path>/.index`."""
+    directory = os.path.join(media_path, INDEX_DIRECTORY)
+    if not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(directory, INDEX_FILE), timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+@contextmanager
+def open_index(media_path):
+    conn = connect(media_path)
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def normalize_path(file_path):
+    # files are looked up by path, however the caller joined it
+    return os.path.abspath(os.path.normpath(file_path))
+
+
+def find_file(media_path, digest):
+    """Returns the stored file with the given sha256 digest, or None.
+
+    Records whose file is gone or has changed size are dropped.
+    """
+    if not digest:
+        return None
+    with open_index(media_path) as conn:
+        row = conn.execute('SELECT * FROM files WHERE digest = ?', (digest,)).fetchone()
+        if row is None:
+            return None
+        if not os.path.isfile(row['path']) or os.path.getsize(row['path']) != row['size']:
+            conn.execute('DELETE FROM files WHERE digest = ?', (digest,))
+            conn.execute('DELETE FROM file_assets WHERE digest = ?', (digest,))
+            return None
+        return {
+            'digest': row['digest'],
+            'path': row['path'],
+            'size': row['size'],
+            'assetId': row['asset_id'],
+            'result': json.loads(row['result']) if row['result'] else None,
+        }
+
+
+def add_file(media_path, digest, file_path, asset_id):
+    with open_index(media_path) as conn:
+        conn.execute('INSERT OR REPLACE INTO files (digest, path, size, asset_id, result, created_at) '
+                     'VALUES (?, ?, ?, ?, NULL, ?)',
+                     (digest, normalize_path(file_path), os.path.getsize(file_path), asset_id, time.time()))
+        conn.execute('INSERT OR IGNORE INTO file_assets (digest, asset_id) VALUES (?, ?)', (digest, asset_id))
+
+
+def add_asset(media_path, digest, asset_id):
+    with open_index(media_path) as conn:
+        conn.execute('INSERT OR IGNORE INTO file_assets (digest, asset_id) VALUES (?, ?)', (digest, asset_id))
+
+
+def save_result(media_path, digest, result):
+    """Stores the asset updates made while processing a file, replayed for its duplicates."""
+    with open_index(media_path) as conn:
+        conn.execute('UPDATE files SET result = ? WHERE digest = ?', (json.dumps(result), digest))
+
+
+def release_file(media_path, file_path, asset_id):
+    """Drops `asset_id`'s reference to `file_path` and returns how many assets still use it."""
+    with open_index(media_path) as conn:
+        row = conn.execute('SELECT digest FROM files WHERE path = ?', (normalize_path(file_path),)).fetchone()
+        if row is None:
+            return 0
+        conn.execute('DELETE FROM file_assets WHERE digest = ? AND asset_id = ?', (row['digest'], asset_id))
+        count = conn.execute('SELECT COUNT(*) FROM file_assets WHERE digest = ?', (row['digest'],)).fetchone()[0]
+        if count == 0:
+            conn.execute('DELETE FROM files WHERE digest = ?', (row['digest'],))
+        return count
+
+
+def scan_files(directory):
+    """Yields the path and stat of every file under `directory`, skipping uploads in progress."""
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from scan_files(entry.path)
+        elif entry.is_file() and not entry.name.endswith('~'):
+            yield entry.path, entry.stat()
+
+
+def probe_file(file_path):
+    try:
+        return media_file(file_path)
+    except Exception as e:
+        print(e)
+        return None
+
+
+def save_media(conn, sources, file_path, stat, meta):
+    path = os.path.relpath(file_path, sources)
+    conn.execute('INSERT OR REPLACE INTO media (path, parent, name, size, mime, duration, stat_size, mtime_ns) '
+                 'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                 (path, os.path.dirname(path), os.path.basename(path), meta['size'], meta['mime'],
+                  meta['duration'], stat.st_size, stat.st_mtime_ns))
+
+
+def sync_media(media_path):
+    """Brings the media table in line with `<media_path>/sources`.
+
+    Files are revalidated by their size and mtime, only new and changed files
+    are sniffed and probed, and files that are gone are dropped.
+    """
+    sources = os.path.join(media_path, 'sources')
+    with open_index(media_path) as conn:
+        known = {row['path']: (row['stat_size'], row['mtime_ns'])
+                 for row in conn.execute('SELECT path, stat_size, mtime_ns FROM media')}
+
+    seen = set()
+    changed = []
+    for file_path, stat in scan_files(sources):
+        path = os.path.relpath(file_path, sources)
+        seen.add(path)
+        if known.get(path) != (stat.st_size, stat.st_mtime_ns):
+            changed.append((file_path, stat))
+
+    with ThreadPoolExecutor() as executor:
+        metas = list(executor.map(probe_file, [file_path for file_path, _ in changed]))
+
+    with open_index(media_path) as conn:
+        for (file_path, stat), meta in zip(changed, metas):
+            if meta is not None:
+                save_media(conn, sources, file_path, stat, meta)
+        conn.executemany('DELETE FROM media WHERE path = ?', [(path,) for path in known.keys() - seen])
+
+
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def iter_media(media_path, exclude=(), cursor=None, mime=None, _type=None, prefix=None, sync=True):
+    """Returns an iterator of the files under `<media_path>/sources` ordered by path.
+
+    Listing resumes after the relative path `cursor`; `mime` matches the MIME
+    type exactly, `_type` its top-level type and `prefix` the directory. The
+    index is synced and queried before returning, so its errors are raised
+    here, and the rows are read lazily, so memory use doesn't grow with the
+    library size.
+    """
+    if sync:
+        sync_media(media_path)
+    exclude = set(exclude)
+    query = 'SELECT * FROM media WHERE 1'
+    params = []
+    if cursor:
+        query += ' AND path > ?'
+        params.append(cursor)
+    if mime:
+        query += ' AND mime = ?'
+        params.append(mime)
+    if _type:
+        query += " AND mime LIKE ? ESCAPE '\\'"
+        params.append(escape_like(_type) + '/%')
+    if prefix:
+        prefix = prefix.strip('/')
+        query += " AND (parent = ? OR parent LIKE ? ESCAPE '\\')"
+        params.extend([prefix, escape_like(prefix) + '/%'])
+    query += ' ORDER BY path'
+
+    conn = connect(media_path)
+    try:
+        rows = conn.execute(query, params)
+    except Exception:
+        conn.close()
+        raise
+    return read_media(conn, rows, exclude)
+
+
+def read_media(conn, rows, exclude):
+    try:
+        for row in rows:
+            if row['path'] in exclude:
+                continue
+            yield {
+                'name': row['name'],
+                'path': row['parent'],
+                'size': row['size'],
+                'MIMEType': row['mime'],
+                'length': row['duration'],
+            }
+    finally:
+        conn.close()
+
+
+def update_media(media_path, file_path, meta=None):
+    """Indexes a single added or changed file, `meta` as returned by `media_file`."""
+    sources = os.path.join(media_path, 'sources')
+    if os.path.relpath(file_path, sources).startswith('..'):
+        return
+    meta = meta or probe_file(file_path)
+    if meta is None:
+        return
+    with open_index(media_path) as conn:
+        save_media(conn, sources, file_path, os.stat(file_path), meta)
+
+
+def remove_media(media_path, file_path):
+    with open_index(media_path) as conn:
+        conn.execute('DELETE FROM media WHERE path = ?', (os.path.relpath(file_path, os.path.join(media_path, 'sources')),))
@@ -1,29 +1,78 @@
 # coding: utf-8
 
-import ipfsapi
-import requests
+import json
 import os
-from ..config import IPFS_API_HOST, IPFS_API_PORT
+import uuid
+from urllib.parse import quote
 
-api = ipfsapi.Client(IPFS_API_HOST, IPFS_API_PORT)
+import requests
+from requests.adapters import HTTPAdapter
+from ..config import IPFS_API_HOST, IPFS_API_PORT, IPFS_API_TIMEOUT, IPFS_ADD_TIMEOUT, IPFS_POOL_SIZE, IPFS_NOCOPY
 
-def add_file(file_path):
-    try:
-        dir = '/'.join(file_path.split('/')[:-1])
-        filename = file_path.replace(dir+'/', '')
-        cur_dir = os.getcwd()
-        os.chdir(dir)
-        resp = api.add(filename, pin=True)
-        os.chdir(cur_dir)
-        if isinstance(resp, list):
-            last_item = resp[-1]
-            print('ipfs hash for file: ', file_path, last_item['Hash'])
-            return last_item['Hash']
-        elif isinstance(resp, dict):
-            print('ipfs hash for file: ', file_path, resp['Hash'])
-            return resp['Hash']
+API_URL = 'http://{}:{}/api/v0'.format(IPFS_API_HOST, IPFS_API_PORT)
+CHUNK_SIZE = 1024 * 1024  # 1MB
+
+# keep-alive connections to the ipfs api, shared by all threads of a process
+adapter = HTTPAdapter(pool_connections=IPFS_POOL_SIZE, pool_maxsize=IPFS_POOL_SIZE)
+session = requests.Session()
+session.mount('http://', adapter)
+
+
+def _entries(path):
+    """Yields the name, path and whether it is a directory of `path` and, for a directory, everything under it.
+
+    Names are relative to the parent of `path`, directories come before their contents.
+    """
+    path = os.path.abspath(path)
+    parent = os.path.dirname(path)
+    if not os.path.isdir(path):
+        yield os.path.basename(path), path, False
+        return
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        yield os.path.relpath(dirpath, parent), dirpath, True
+        for filename in sorted(filenames):
+            file = os.path.join(dirpath, filename)
+            yield os.path.relpath(file, parent), file, False
+
+
+def _multipart(path, boundary, nocopy=False):
+    """Streams `path` as the multipart/form-data body of an add, reading the files as it is sent."""
+    for name, abspath, is_dir in _entries(path):
+        headers = 'Content-Disposition: form-data; name="file"; filename="{}"\r\n'.format(quote(name, safe=''))
+        if is_dir:
+            headers += 'Content-Type: application/x-directory\r\n'
         else:
+            headers += 'Content-Type: application/octet-stream\r\n'
+            if nocopy:
+                # where the filestore reads the blocks from
+                headers += 'Abspath: {}\r\n'.format(abspath)
+        yield '--{}\r\n{}\r\n'.format(boundary, headers).encode('utf-8')
+        if not is_dir:
+            with open(abspath, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    yield chunk
+        yield b'\r\n'
+    yield '--{}--\r\n'.format(boundary).encode('utf-8')
+
+
+def add_file(file_path, nocopy=IPFS_NOCOPY):
+    """Adds and pins a file, or a directory with everything under it, returns its hash or None."""
+    try:
+        boundary = uuid.uuid4().hex
+        params = {'pin': 'true'}
+        if nocopy:
+            params['nocopy'] = 'true'
+        resp = session.post('{}/add'.format(API_URL), params=params, data=_multipart(file_path, boundary, nocopy),
+                            headers={'Content-Type': 'multipart/form-data; boundary={}'.format(boundary)},
+                            timeout=(IPFS_API_TIMEOUT, IPFS_ADD_TIMEOUT))
+        resp.raise_for_status()
+        # one line per added file and directory, the given path is the last one
+        items = [json.loads(line) for line in resp.iter_lines() if line]
+        if not items or 'Hash' not in items[-1]:
             return None
+        print('ipfs hash for file: ', file_path, items[-1]['Hash'])
+        return items[-1]['Hash']
 
     except Exception as e:
         print(e)
@@ -35,10 +84,10 @@ def pin_file(hash):
         params = (
             ('arg', hash),
         )
-        url = 'http://{}:{}/api/v0/pin/add'.format(IPFS_API_HOST, IPFS_API_PORT)
+        url = '{}/pin/add'.format(API_URL)
         print('Pinning on IPFS ...')
         print(url, params)
-        response = requests.post(url, params=params)
+        response = session.post(url, params=params, timeout=(IPFS_API_TIMEOUT, IPFS_ADD_TIMEOUT))
         response = response.json()
         if 'Pins' in dict(response).keys() and len(response['Pins']) > 0:
             return True
@@ -47,4 +96,4 @@ def pin_file(hash):
 
     except Exception as e:
         print(e)
-        return False
\ No newline at end of file
+        return False
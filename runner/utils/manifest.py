@@ -0,0 +1,76 @@
+# coding: utf-8
+import json
+import os
+import threading
+
+MANIFEST_FILE = 'encode_manifest.json'
+
+
+def source_signature(file_path):
+    stat = os.stat(file_path)
+    return {
+        'path': os.path.abspath(file_path),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+    }
+
+
+def clear_manifest(folder):
+    """Forgets the completed stages of an asset, its next encode starts over."""
+    try:
+        os.remove(os.path.join(folder, MANIFEST_FILE))
+    except FileNotFoundError:
+        pass
+
+
+class EncodeManifest:
+    """Completed stages of an asset's processing, kept in `<folder>/encode_manifest.json`.
+
+    Stages recorded for another version of the source file, or with other encode
+    `settings`, are discarded, so a retried job only skips the work that is still
+    valid. Without `settings` the stored ones are kept.
+    """
+
+    def __init__(self, folder, file_path, settings=None):
+        self.folder = folder
+        self.manifest_file = os.path.join(folder, MANIFEST_FILE)
+        self.lock = threading.Lock()
+        self.source = source_signature(file_path)
+        self.settings = settings
+        self.stages = {}
+        self.valid = False
+        try:
+            with open(self.manifest_file, 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return
+        if manifest.get('source') != self.source:
+            return
+        if settings is not None and manifest.get('settings') != settings:
+            return
+        self.settings = manifest.get('settings')
+        self.stages = manifest.get('stages') or {}
+        self.valid = True
+
+    def done(self, stage):
+        return stage in self.stages
+
+    def get(self, stage, default=None):
+        return self.stages.get(stage, default)
+
+    def complete(self, stage, value=True):
+        with self.lock:
+            self.stages[stage] = value
+            self._write()
+
+    def save(self):
+        with self.lock:
+            self._write()
+
+    def _write(self):
+        os.makedirs(self.folder, exist_ok=True)
+        temp_file = self.manifest_file + '~'
+        with open(temp_file, 'w') as f:
+            json.dump({'source': self.source, 'settings': self.settings, 'stages': self.stages}, f)
+        # replaced at once, an interrupted job never leaves a partial manifest
+        os.replace(temp_file, self.manifest_file)
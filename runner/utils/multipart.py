@@ -0,0 +1,128 @@
+# coding: utf-8
+from email.message import Message
+
+CHUNK_SIZE = 1024 * 1024  # 1MB
+MAX_HEADER_SIZE = 64 * 1024
+MAX_FIELD_SIZE = 1024 * 1024
+
+
+def get_boundary(content_type):
+    message = Message()
+    message['content-type'] = content_type or ''
+    boundary = message.get_param('boundary')
+    if not boundary or message.get_content_type() != 'multipart/form-data':
+        return None
+    return boundary.encode('latin-1')
+
+
+class Part:
+    def __init__(self, reader, headers):
+        self.reader = reader
+        self.headers = headers
+        self.name = headers.get_param('name', header='content-disposition')
+        self.filename = headers.get_filename()
+        self.content_type = headers.get_content_type()
+        self.consumed = False
+
+    def chunks(self):
+        if self.consumed:
+            return
+        self.consumed = True
+        yield from self.reader.iter_body()
+
+    def read(self, limit=MAX_FIELD_SIZE):
+        data = b''
+        for chunk in self.chunks():
+            data += chunk
+            if len(data) > limit:
+                raise ValueError('multipart field {} is too large'.format(self.name))
+        return data
+
+    def value(self, encoding='utf-8'):
+        return self.read().decode(encoding)
+
+    def save(self, file_path, on_chunk=None):
+        """Writes the part body to `file_path` and returns the number of bytes written."""
+        size = 0
+        with open(file_path, 'wb') as f:
+            for chunk in self.chunks():
+                if on_chunk is not None:
+                    on_chunk(chunk)
+                f.write(chunk)
+                size += len(chunk)
+        return size
+
+    def drain(self):
+        for _ in self.chunks():
+            pass
+
+
+class MultipartReader:
+    """Incremental `multipart/form-data` parser.
+
+    Parts are yielded in body order and must be consumed before moving on to the
+    next one; memory use is bounded by `chunk_size` regardless of the body size.
+    """
+
+    def __init__(self, stream, boundary, chunk_size=CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.delimiter = b'\r\n--' + boundary
+        # lets the first boundary, which has no leading CRLF, match the delimiter
+        self.buffer = b'\r\n'
+
+    def _fill(self):
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            return False
+        self.buffer += chunk
+        return True
+
+    def iter_body(self):
+        keep = len(self.delimiter) - 1
+        while True:
+            index = self.buffer.find(self.delimiter)
+            if index >= 0:
+                data = self.buffer[:index]
+                self.buffer = self.buffer[index + len(self.delimiter):]
+                if data:
+                    yield data
+                return
+            if len(self.buffer) > keep:
+                data = self.buffer[:-keep]
+                self.buffer = self.buffer[-keep:]
+                yield data
+            if not self._fill():
+                raise ValueError('unexpected end of multipart body')
+
+    def _read_headers(self):
+        while True:
+            index = self.buffer.find(b'\r\n\r\n')
+            if index >= 0:
+                raw = self.buffer[:index]
+                self.buffer = self.buffer[index + 4:]
+                break
+            if len(self.buffer) > MAX_HEADER_SIZE:
+                raise ValueError('multipart headers are too large')
+            if not self._fill():
+                raise ValueError('unexpected end of multipart body')
+
+        headers = Message()
+        for line in raw.decode('utf-8', 'replace').split('\r\n'):
+            if ':' in line:
+                key, value = line.split(':', 1)
+                headers[key.strip()] = value.strip()
+        return headers
+
+    def __iter__(self):
+        # skip the preamble
+        for _ in self.iter_body():
+            pass
+        while True:
+            while len(self.buffer) < 2 and self._fill():
+                pass
+            if self.buffer.startswith(b'--'):
+                return
+            part = Part(self, self._read_headers())
+            yield part
+            part.drain()
@@ -0,0 +1,185 @@
+# coding: utf-8
+import fcntl
+import hashlib
+import json
+import os
+import re
+import time
+from contextlib import contextmanager
+
+from .download import merge_ranges
+from .file import gen_random_id, media_root
+from ..config import UPLOAD_SESSION_TTL
+
+CHUNK_SIZE = 1024 * 1024  # 1MB
+UPLOAD_ID_PATTERN = re.compile(r'^[0-9a-zA-Z]{32}$')
+
+
+def uploads_path(root_path):
+    return os.path.join(media_root(root_path), 'uploads')
+
+
+def sweep_sessions(directory, ttl=UPLOAD_SESSION_TTL):
+    """Removes the upload sessions in `directory` untouched for `ttl` seconds.
+
+    Returns the bytes the remaining sessions are still to receive.
+    """
+    if not os.path.isdir(directory):
+        return 0
+    # the spooled multipart uploads share the directory
+    upload_ids = {os.path.splitext(name)[0] for name in os.listdir(directory)
+                  if os.path.splitext(name)[1] in ('.json', '.part')}
+    pending, now = 0, time.time()
+    for upload_id in upload_ids:
+        if not UPLOAD_ID_PATTERN.match(upload_id):
+            continue
+        paths = [os.path.join(directory, upload_id + extension) for extension in ('.part', '.json')]
+        try:
+            touched = max(os.path.getmtime(path) for path in paths if os.path.exists(path))
+        except (OSError, ValueError):
+            continue
+        if now - touched > ttl:
+            print('removing stale upload', upload_id)
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+            continue
+        try:
+            with open(paths[1], 'r') as f:
+                manifest = json.load(f)
+            pending += manifest['size'] - sum(end - start for start, end in manifest['received'])
+        except (OSError, ValueError, KeyError):
+            # being written or without a manifest
+            continue
+    return pending
+
+
+class UploadSession:
+    """State of a resumable upload.
+
+    Chunks are written in place into a preallocated `<id>.part` file and the
+    received byte ranges, `[start, end)`, are tracked in an `<id>.json` manifest
+    that is updated under an exclusive lock, so chunks may arrive in any order
+    and in parallel. Chunks are written holding a shared lock on the manifest,
+    completing the upload holds it exclusively.
+    """
+
+    def __init__(self, root_path, upload_id):
+        if not UPLOAD_ID_PATTERN.match(upload_id or ''):
+            raise ValueError('invalid upload id')
+        self.upload_id = upload_id
+        self.directory = uploads_path(root_path)
+        self.part_file = os.path.join(self.directory, upload_id + '.part')
+        self.manifest_file = os.path.join(self.directory, upload_id + '.json')
+
+    @classmethod
+    def create(cls, root_path, user_id, filename, _type, size, asset_id=None):
+        session = cls(root_path, gen_random_id(32))
+        if not os.path.exists(session.directory):
+            os.makedirs(session.directory)
+        with open(session.part_file, 'wb') as f:
+            f.truncate(size)
+        manifest = {
+            'uploadId': session.upload_id,
+            'userId': user_id,
+            'assetId': asset_id,
+            'filename': filename,
+            '_type': _type,
+            'size': size,
+            'received': [],
+            'createdAt': time.time(),
+        }
+        with open(session.manifest_file, 'w') as f:
+            json.dump(manifest, f)
+        return session
+
+    def exists(self):
+        return os.path.exists(self.manifest_file) and os.path.exists(self.part_file)
+
+    @contextmanager
+    def _locked(self, operation):
+        with open(self.manifest_file, 'r+') as f:
+            fcntl.flock(f, operation)
+            try:
+                yield f
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def status(self):
+        with self._locked(fcntl.LOCK_SH) as f:
+            return self._status(json.load(f))
+
+    @staticmethod
+    def _status(manifest):
+        manifest['bytesReceived'] = sum(end - start for start, end in manifest['received'])
+        # first byte that hasn't been received, where a sequential client resumes from
+        received = manifest['received']
+        manifest['offset'] = received[0][1] if received and received[0][0] == 0 else 0
+        manifest['complete'] = manifest['bytesReceived'] == manifest['size']
+        return manifest
+
+    def write_chunk(self, stream, offset, length):
+        """Copies `length` bytes from `stream` into the upload at `offset`, returns the bytes written."""
+        written = 0
+        with self._locked(fcntl.LOCK_SH) as f:
+            # raises once the upload is completed or aborted
+            with open(self.part_file, 'r+b') as part:
+                part.seek(offset)
+                while written < length:
+                    chunk = stream.read(min(CHUNK_SIZE, length - written))
+                    if not chunk:
+                        break
+                    part.write(chunk)
+                    written += len(chunk)
+            if written:
+                # converting the lock isn't atomic, the manifest is read again once it's held
+                fcntl.flock(f, fcntl.LOCK_EX)
+                manifest = json.load(f)
+                manifest['received'] = merge_ranges(manifest['received'] + [[offset, offset + written]],
+                                                    inclusive=False)
+                f.seek(0)
+                f.truncate()
+                json.dump(manifest, f)
+                # written out before the lock is released
+                f.flush()
+        return written
+
+    def complete(self, get_file_path):
+        """Moves a fully received upload to `get_file_path(status)` and removes the session.
+
+        Returns the upload status, with the `path` and sha256 `digest` of the file
+        once it's moved. Chunks can't be written meanwhile and a concurrent call
+        finds the session gone, raising FileNotFoundError.
+        """
+        with self._locked(fcntl.LOCK_EX) as f:
+            status = self._status(json.load(f))
+            if not os.path.exists(self.part_file):
+                raise FileNotFoundError(self.part_file)
+            if not status['complete']:
+                return status
+            file_path = get_file_path(status)
+            # chunks may arrive out of order, so the digest can't be computed while receiving them
+            with open(self.part_file, 'rb') as part:
+                status['digest'] = hashlib.file_digest(part, 'sha256').hexdigest()
+            os.rename(self.part_file, file_path)
+            os.remove(self.manifest_file)
+        status['path'] = file_path
+        return status
+
+    def restore(self, status):
+        """Puts a completed upload back as a session, for it to be completed again.
+
+        Does nothing when its file is no longer at `status['path']`.
+        """
+        if not os.path.exists(status['path']):
+            return
+        manifest = {key: value for key, value in status.items()
+                    if key not in ('bytesReceived', 'offset', 'complete', 'digest', 'path')}
+        os.rename(status['path'], self.part_file)
+        with open(self.manifest_file, 'w') as f:
+            json.dump(manifest, f)
+
+    def abort(self):
+        for path in (self.part_file, self.manifest_file):
+            if os.path.exists(path):
+                os.remove(path)